@@ -1,12 +1,18 @@
 from argparse import ArgumentParser, BooleanOptionalAction
-from glob import glob
 from logging import getLogger
-from os.path import basename, join
+from os.path import exists, join
 
-from dask.dataframe import read_parquet as dask_read_parquet
-from pandas import read_parquet
+from pyarrow.dataset import field as pyarrow_field
 
-from process.utils import read_obs, setup_logging
+from process import RAW_DATASET, SUMMARY_DATASET
+from process.dataset import open_dataset
+from process.utils import (
+    read_all_state_counts,
+    read_cached_state_counts,
+    read_obs,
+    setup_logging,
+)
+from process.vis.stats import EnsembleStats
 from process.vis.wrapper import plot_wrapper
 
 
@@ -17,7 +23,12 @@ def main(
     obs_loc_list: list = ["Counties Manukau"],
     only_group_data: bool = False,
     model_ids: list or None = None,
-    use_dask: bool = True,
+    workers: int = 8,
+    regions: list or None = None,
+    exps: list or None = None,
+    use_cache: bool = True,
+    merge_stats: list or None = None,
+    max_plot_members: int or None = None,
 ):
     """_summary_
 
@@ -27,6 +38,24 @@ def main(
         obs_path (str, optional): Observation path.
             Defaults to "/home/zhangs/Github/EpiModel_ESR/etc/test_data/measles_cases_2019.parquet".
         obs_ref_year (int, optional): Observation year. Defaults to 2019.
+        model_ids (list or None, optional): Model IDs, None for all models.
+            Defaults to None.
+        workers (int, optional): Number of threads reading the outputs.
+            Defaults to 8.
+        regions (list or None, optional): Regions, None for all regions.
+            Defaults to None.
+        exps (list or None, optional): Experiments, None for all experiments.
+            Defaults to None.
+        use_cache (bool, optional): If only the new or changed outputs are
+            read, e.g., the counts of the other outputs are taken from the
+            cache in {base_dir}/vis/cache. Defaults to True.
+        merge_stats (list or None, optional): Ensemble statistics (.npz) saved
+            by other jobs (e.g., for other model_ids), merged for the
+            percentiles. The statistics of this job are saved in
+            {base_dir}/vis/stats. Defaults to None.
+        max_plot_members (int or None, optional): Maximum number of members
+            plotted (and exported) as lines, None for all members.
+            Defaults to None.
     """
     logger = setup_logging(workdir=base_dir, log_type="epimodel_esr_ens_vis")
     logger.info(base_dir)
@@ -41,65 +70,63 @@ def main(
     # obs = read_obs("etc/test_data/measles_cases_2019.parquet", ["Hutt Valley"])
     obs = None
     proc_data_list = []
+    # the summary outputs are used if they are available
+    use_summary = exists(join(base_dir, "output", SUMMARY_DATASET))
+    dataset_dir = join(
+        base_dir, "output", SUMMARY_DATASET if use_summary else RAW_DATASET
+    )
 
-    if model_ids is None:
-        all_files1 = glob(join(base_dir, "output_pp", "output_model_*.parquet"))
-    else:
-        all_files1 = []
-        for proc_model_id in model_ids:
-            all_files1.extend(
-                glob(
-                    join(
-                        base_dir, "output_pp", f"output_model_{proc_model_id}_*.parquet"
-                    )
-                )
-            )
-
-    all_filesname1 = []
-    for proc_file in all_files1:
-        all_filesname1.append(basename(proc_file))
-
-    all_filesname1 = []
-    if model_ids is None:
-        all_files2 = glob(join(base_dir, "output", "output_model_*.parquet"))
+    # the files are pruned by the partitions (e.g., model_id)
+    dataset_filter = None
+    cache_name = SUMMARY_DATASET if use_summary else RAW_DATASET
+    for partition_key, partition_values in {
+        "region": regions,
+        "exp": exps,
+        "model_id": model_ids,
+    }.items():
+        if partition_values is None:
+            continue
+        cache_name += f"_{partition_key}_{'_'.join(map(str, partition_values))}"
+        partition_filter = pyarrow_field(partition_key).isin(
+            [str(proc_value) for proc_value in partition_values]
+        )
+        dataset_filter = (
+            partition_filter
+            if dataset_filter is None
+            else dataset_filter & partition_filter
+        )
+
+    all_files = [
+        proc_fragment.path
+        for proc_fragment in open_dataset(dataset_dir).get_fragments(
+            filter=dataset_filter
+        )
+    ]
+
+    # each output is reduced to the daily counts as soon as it is read,
+    # so the memory does not depend on the number of outputs
+    if use_cache:
+        # each selection of the outputs (e.g., the model_ids of a job) has
+        # its own cache, so the jobs never write the same cache
+        proc_data_list = read_cached_state_counts(
+            all_files,
+            [2],
+            join(base_dir, "vis", "cache", f"ens_{cache_name}.pickle"),
+            use_summary=use_summary,
+            workers=workers,
+        )
     else:
-        all_files2 = []
-        for proc_model_id in model_ids:
-            all_files2.extend(
-                glob(
-                    join(base_dir, "output", f"output_model_{proc_model_id}_*.parquet")
-                )
-            )
-
-    all_filesname2 = []
-    for proc_file in all_files2:
-        all_filesname2.append(basename(proc_file))
-
-    all_filename = list(set(all_filesname1 + all_filesname2))
-
-    all_files = []
-
-    for proc_filename in all_filename:
-        if proc_filename in all_filesname1:
-            all_files.append(join(base_dir, "output_pp", proc_filename))
-        else:
-            all_files.append(join(base_dir, "output", proc_filename))
-
-    total_files = len(all_files)
-
-    for i, proc_file in enumerate(all_files):
-        logger.info(f"{i}/{total_files} ...")
-        if use_dask:
-            proc_data = dask_read_parquet(
-                proc_file, columns=["Step", "State_new_2"], blocksize="10MB"
-            )
-        else:
-            proc_data = read_parquet(proc_file)[["Step", "State_new_2"]]
-        proc_data["State_new_2"] = proc_data["State_new_2"].astype("int8")
-        # proc_data = proc_data.compute()
-        proc_data_list.append(proc_data)
-
-    if len(proc_data_list) == 0:
+        proc_data_list = read_all_state_counts(
+            all_files, [2], use_summary=use_summary, workers=workers
+        )
+
+    # the statistics of the other jobs are merged, so the percentiles cover
+    # the whole ensemble without reading the outputs again
+    other_stats = {}
+    if merge_stats is not None:
+        other_stats[2] = [EnsembleStats.load(stats_path) for stats_path in merge_stats]
+
+    if len(proc_data_list) == 0 and len(other_stats) == 0:
         return
 
     logger.info("Plotting ...")
@@ -116,7 +143,10 @@ def main(
         remove_outlier=False,
         model_ids=model_ids,
         only_group_data=only_group_data,
-        use_dask=use_dask,
+        use_summary=True,
+        stats_path=join(base_dir, "vis", "stats", f"ens_{cache_name}"),
+        other_stats=other_stats,
+        max_plot_members=max_plot_members,
         # ylim_range=[0, 250],
     )
 
@@ -167,6 +197,53 @@ if __name__ == "__main__":
         required=False,
     )
 
+    parser.add_argument(
+        "--workers",
+        type=int,
+        required=False,
+        default=8,
+        help="Number of threads reading the outputs",
+    )
+
+    parser.add_argument(
+        "--regions",
+        nargs="+",
+        help="Regions",
+        default=None,
+        required=False,
+    )
+
+    parser.add_argument(
+        "--exps",
+        nargs="+",
+        help="Experiments",
+        default=None,
+        required=False,
+    )
+
+    parser.add_argument(
+        "--use_cache",
+        action=BooleanOptionalAction,
+        default=True,
+        help="Only read the new or changed outputs",
+    )
+
+    parser.add_argument(
+        "--merge_stats",
+        nargs="+",
+        help="Ensemble statistics (.npz) of other jobs to be merged",
+        default=None,
+        required=False,
+    )
+
+    parser.add_argument(
+        "--max_plot_members",
+        type=int,
+        required=False,
+        default=None,
+        help="Maximum number of members plotted (and exported) as lines",
+    )
+
     args = parser.parse_args(
         #    [
         #        "--base_dir",
@@ -183,4 +260,10 @@ if __name__ == "__main__":
         args.obs_loc_list,
         args.only_group_data,
         args.model_ids,
+        workers=args.workers,
+        regions=args.regions,
+        exps=args.exps,
+        use_cache=args.use_cache,
+        merge_stats=args.merge_stats,
+        max_plot_members=args.max_plot_members,
     )
@@ -1,5 +1,12 @@
 SA2_DATA_PATH = "etc/dhb_and_sa2.parquet"
-SAVED_MODEL_PATH = "{workdir}/model_{id}.dill"
+SAVED_MODEL_PATH = "{workdir}/model_{id}"
+# the inputs preprocessed once (e.g., obs) are cached here
+CACHE_DIR = "/tmp/epimodel_esr/cache"
+# the least recently used preprocessed syspop inputs are evicted above (bytes)
+SYSPOP_CACHE_SIZE = 10 * 1024**3
+# the model outputs are partitioned datasets in the output directory
+RAW_DATASET = "raw"
+SUMMARY_DATASET = "summary"
 
 DIARY_TYPES = [
     "household",
@@ -34,6 +41,9 @@ INFECTED_NO_REPORT_RATIO = 0.0
 
 TOTAL_TIMESTEPS = 180
 
+# lower bounds of the age bands used to split the summary outputs
+SUMMARY_AGE_BANDS = [0, 5, 12, 18, 30, 50, 65]
+
 VIS_COLOR = {0: "red", 1: "green", 2: "grey"}
 
 DEBUG_FLAG = True
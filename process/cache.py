@@ -0,0 +1,229 @@
+from glob import glob
+from hashlib import sha256
+from json import dumps as json_dumps
+from logging import getLogger
+from os import getpid, makedirs, rename, replace, utime
+from os.path import abspath, basename, dirname, exists, getmtime, getsize, join
+from pickle import HIGHEST_PROTOCOL, UnpicklingError
+from pickle import dump as pickle_dump
+from pickle import load as pickle_load
+from shutil import rmtree
+
+from pandas import DataFrame
+from pandas import read_parquet as pandas_read_parquet
+
+from process.dataset import obtain_checksum
+
+logger = getLogger()
+
+# the caches written by another version are ignored (and rebuilt)
+CACHE_VERSION = 4
+
+
+def get_file_key(file_path: str) -> tuple:
+    """Obtain the key of a file for the caches, e.g., a cached result is
+    only used if the file is not changed since
+
+    Args:
+        file_path (str): file path
+
+    Returns:
+        tuple: modification time and size
+    """
+    return (getmtime(file_path), getsize(file_path))
+
+
+def get_cache_path(
+    cache_dir: str, cache_type: str, cache_key: dict, suffix: str = ".pickle"
+) -> str:
+    """Obtain the path of a cache from its key, e.g., the same inputs
+    always use the same cache
+
+    Args:
+        cache_dir (str): cache directory
+        cache_type (str): cache type, e.g., obs
+        cache_key (dict): cache key (json serializable), e.g., the inputs
+        suffix (str, optional): suffix of the cache path. Defaults to ".pickle".
+
+    Returns:
+        str: cache path
+    """
+    key_hash = sha256(
+        json_dumps(cache_key, sort_keys=True, default=str).encode()
+    ).hexdigest()
+    return join(cache_dir, cache_type, f"{key_hash}{suffix}")
+
+
+def obtain_file_hash(file_path: str, cache_dir: str) -> str:
+    """Obtain the checksum of a file content, the checksum is cached by the
+    file path, modification time and size, so a large file is only read
+    again when it is changed
+
+    Args:
+        file_path (str): file path
+        cache_dir (str): cache directory
+
+    Returns:
+        str: checksum
+    """
+    cache_path = get_cache_path(
+        cache_dir,
+        "checksum",
+        {"file_path": abspath(file_path), "file_key": get_file_key(file_path)},
+    )
+    cache = read_cache(cache_path)
+    if cache is not None:
+        return cache["checksum"]
+
+    checksum = obtain_checksum(file_path)
+    write_cache(cache_path, {"checksum": checksum})
+    return checksum
+
+
+def read_cache(cache_path: str) -> dict or None:
+    """Read a cache
+
+    Args:
+        cache_path (str): cache path
+
+    Returns:
+        dict or None: cached data, None if the cache does not exist or
+            can not be used (e.g., another version)
+    """
+    if not exists(cache_path):
+        return None
+
+    try:
+        with open(cache_path, "rb") as fid:
+            cache = pickle_load(fid)
+    except (EOFError, UnpicklingError) as error:
+        logger.warning(f"Ignoring the cache {cache_path}: {error}")
+        return None
+
+    if cache.get("version") != CACHE_VERSION:
+        return None
+
+    return cache["data"]
+
+
+def write_cache(cache_path: str, cache_data: dict):
+    """Write a cache, through a temporary file so the readers (e.g., other
+    jobs) never see a partially written cache
+
+    Args:
+        cache_path (str): cache path
+        cache_data (dict): data to be cached
+    """
+    makedirs(dirname(cache_path), exist_ok=True)
+    tmp_cache_path = f"{cache_path}.{getpid()}.tmp"
+    with open(tmp_cache_path, "wb") as fid:
+        pickle_dump(
+            {"version": CACHE_VERSION, "data": cache_data},
+            fid,
+            protocol=HIGHEST_PROTOCOL,
+        )
+    replace(tmp_cache_path, cache_path)
+
+
+def read_table_cache(cache_dir: str, cache_type: str, cache_key: dict) -> dict or None:
+    """Read cached tables, e.g., the preprocessed inputs
+
+    Args:
+        cache_dir (str): cache directory
+        cache_type (str): cache type, e.g., syspop
+        cache_key (dict): cache key, e.g., the checksums of the inputs
+
+    Returns:
+        dict or None: tables, None if they are not cached (or the entry is
+            evicted by another job while being read)
+    """
+    entry_dir = get_cache_path(
+        cache_dir, cache_type, {**cache_key, "version": CACHE_VERSION}, suffix=""
+    )
+    if not exists(entry_dir):
+        return None
+
+    try:
+        # the modification time of the entry records the last use for the eviction
+        utime(entry_dir)
+        tables = {
+            basename(table_path)[: -len(".parquet")]: pandas_read_parquet(table_path)
+            for table_path in sorted(glob(join(entry_dir, "*.parquet")))
+        }
+    except FileNotFoundError:
+        logger.info(f"The cache {entry_dir} is evicted while being read ...")
+        return None
+
+    if len(tables) == 0:
+        return None
+
+    return tables
+
+
+def write_table_cache(
+    cache_dir: str, cache_type: str, cache_key: dict, tables: dict, max_size: int
+):
+    """Write tables to the cache (as Parquet), the least recently used entries
+    of the cache type are then evicted until the cache fits in max_size
+
+    Args:
+        cache_dir (str): cache directory
+        cache_type (str): cache type, e.g., syspop
+        cache_key (dict): cache key, e.g., the checksums of the inputs
+        tables (dict): tables (DataFrame) to be cached, None is not cached
+        max_size (int): maximum size (bytes) of the cache type
+    """
+    entry_dir = get_cache_path(
+        cache_dir, cache_type, {**cache_key, "version": CACHE_VERSION}, suffix=""
+    )
+    tmp_entry_dir = f"{entry_dir}.{getpid()}.tmp"
+    makedirs(tmp_entry_dir, exist_ok=True)
+    for table_name, table in tables.items():
+        if isinstance(table, DataFrame):
+            table.to_parquet(join(tmp_entry_dir, f"{table_name}.parquet"))
+
+    try:
+        rename(tmp_entry_dir, entry_dir)
+    except OSError:
+        # the same entry is written by another job
+        rmtree(tmp_entry_dir, ignore_errors=True)
+
+    evict_cache(join(cache_dir, cache_type), max_size)
+
+
+def evict_cache(cache_type_dir: str, max_size: int):
+    """Remove the least recently used entries until the cache fits in
+    max_size, the most recently used entry is always kept. An entry is moved
+    aside before being removed, so the readers never see a partially
+    removed entry
+
+    Args:
+        cache_type_dir (str): cache directory of a cache type
+        max_size (int): maximum size (bytes)
+    """
+    all_entries = []
+    for entry_dir in glob(join(cache_type_dir, "*")):
+        if entry_dir.endswith((".tmp", ".evict")):
+            continue
+        all_entries.append(
+            (
+                getmtime(entry_dir),
+                sum(getsize(table_path) for table_path in glob(join(entry_dir, "*"))),
+                entry_dir,
+            )
+        )
+
+    total_size = 0
+    for entry_i, (_, entry_size, entry_dir) in enumerate(
+        sorted(all_entries, reverse=True)
+    ):
+        total_size += entry_size
+        if entry_i > 0 and total_size > max_size:
+            logger.info(f"Evicting the cache {entry_dir} ...")
+            evicted_entry_dir = f"{entry_dir}.{getpid()}.evict"
+            try:
+                rename(entry_dir, evicted_entry_dir)
+            except OSError:
+                # the entry is evicted by another job
+                continue
+            rmtree(evicted_entry_dir, ignore_errors=True)
@@ -0,0 +1,311 @@
+from glob import glob
+from hashlib import sha256
+from json import dump as json_dump
+from json import load as json_load
+from logging import getLogger
+from os import getpid, makedirs, replace
+from os.path import dirname, exists, getsize, join, relpath
+from urllib.parse import quote
+from uuid import uuid4
+
+from pandas import DataFrame
+from pyarrow import int32, schema, string
+from pyarrow.dataset import Dataset, HivePartitioning
+from pyarrow.dataset import dataset as pyarrow_dataset
+from pyarrow.parquet import read_metadata
+
+logger = getLogger()
+
+# the model outputs are partitioned as region/exp/model_id/ens, e.g.,
+#   {dataset_dir}/region=Auckland/exp=0/model_id=1/ens=0/part-0.parquet
+DATASET_PARTITIONING = HivePartitioning(
+    schema(
+        [
+            ("region", string()),
+            ("exp", string()),
+            ("model_id", string()),
+            ("ens", int32()),
+        ]
+    )
+)
+DATASET_FILENAME = "part-0.parquet"
+
+# decode table of the AgentID codes, shared by the files of all ensemble
+# members of a model, e.g., {dataset_dir}/region=/exp=/model_id=/_agents.parquet
+AGENTS_FILENAME = "_agents.parquet"
+
+# manifest of each file (next to the file) and of the whole dataset,
+# e.g., the files starting with "_" are ignored by pyarrow.dataset
+MANIFEST_FILENAME = "_manifest.json"
+MANIFEST_VERSION = 1
+
+# token of the last change to the dataset (e.g., a new file manifest), the
+# manifest of the dataset is stale if it was not collected at this token
+CHANGES_FILENAME = "_changes.json"
+
+
+def get_dataset_path(dataset_dir: str, partition: dict) -> str:
+    """Obtain the path of a file in the partitioned dataset
+
+    Args:
+        dataset_dir (str): Dataset directory
+        partition (dict): region, exp, model_id and ens of the file
+
+    Returns:
+        str: file path
+    """
+    return join(
+        dataset_dir,
+        *[
+            f"{partition_key}={quote(str(partition[partition_key]), safe='')}"
+            for partition_key in DATASET_PARTITIONING.schema.names
+        ],
+        DATASET_FILENAME,
+    )
+
+
+def get_agents_path(file_path: str) -> str:
+    """Obtain the path of the AgentID decode table of a file in the dataset
+
+    Args:
+        file_path (str): file path, e.g., from get_dataset_path
+
+    Returns:
+        str: decode table path
+    """
+    return join(dirname(dirname(file_path)), AGENTS_FILENAME)
+
+
+def write_agents_table(dataset_dir: str, partition: dict, agents: DataFrame):
+    """Write the AgentID decode table of a model, through a temporary file
+    so the readers never see a partially written table
+
+    Args:
+        dataset_dir (str): Dataset directory
+        partition (dict): region, exp and model_id of the model
+        agents (DataFrame): decode table, e.g., from AgentsStore.decode_table
+    """
+    agents_path = get_agents_path(
+        get_dataset_path(dataset_dir, {**partition, "ens": 0})
+    )
+    makedirs(dirname(agents_path), exist_ok=True)
+    tmp_agents_path = f"{agents_path}.{getpid()}.tmp"
+    agents.to_parquet(tmp_agents_path, index=False)
+    replace(tmp_agents_path, agents_path)
+
+
+def write_json(json_path: str, json_data: dict):
+    """Write a json file, through a temporary file so the readers never see
+    a partially written file
+
+    Args:
+        json_path (str): json path
+        json_data (dict): json data
+    """
+    tmp_json_path = f"{json_path}.{getpid()}.tmp"
+    with open(tmp_json_path, "w") as fid:
+        json_dump(json_data, fid)
+    replace(tmp_json_path, json_path)
+
+
+def obtain_checksum(file_path: str, chunk_size: int = 1048576) -> str:
+    """Obtain the sha256 checksum of a file
+
+    Args:
+        file_path (str): file path
+        chunk_size (int, optional): bytes read at once. Defaults to 1048576.
+
+    Returns:
+        str: checksum
+    """
+    checksum = sha256()
+    with open(file_path, "rb") as fid:
+        for chunk in iter(lambda: fid.read(chunk_size), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def write_file_manifest(dataset_dir: str, partition: dict):
+    """Write the manifest of a file in the dataset, e.g., row count, schema
+    and checksum. The manifest is written next to the file, so jobs writing
+    different partitions never write the same manifest. The change token of
+    the dataset is renewed afterwards, so the manifest of the dataset is
+    known to be stale
+
+    Args:
+        dataset_dir (str): Dataset directory
+        partition (dict): region, exp, model_id and ens of the file
+    """
+    file_path = get_dataset_path(dataset_dir, partition)
+    file_metadata = read_metadata(file_path)
+    write_json(
+        join(dirname(file_path), MANIFEST_FILENAME),
+        {
+            "path": relpath(file_path, dataset_dir),
+            "partition": partition,
+            "num_rows": file_metadata.num_rows,
+            "num_row_groups": file_metadata.num_row_groups,
+            "size": getsize(file_path),
+            "sha256": obtain_checksum(file_path),
+            "schema": file_metadata.schema.to_arrow_schema().to_string(
+                show_schema_metadata=False
+            ),
+        },
+    )
+    write_json(join(dataset_dir, CHANGES_FILENAME), {"token": uuid4().hex})
+
+
+def read_changes(dataset_dir: str) -> str or None:
+    """Read the change token of the dataset
+
+    Args:
+        dataset_dir (str): Dataset directory
+
+    Returns:
+        str or None: token, None if the dataset has no token
+    """
+    changes_path = join(dataset_dir, CHANGES_FILENAME)
+    if not exists(changes_path):
+        return None
+
+    with open(changes_path, "r") as fid:
+        return json_load(fid)["token"]
+
+
+def read_file_manifests(dataset_dir: str) -> list:
+    """Read the manifests of all files in the dataset, e.g., the files
+    completely written by any job (a file only gets its manifest once it is
+    closed)
+
+    Args:
+        dataset_dir (str): Dataset directory
+
+    Returns:
+        list: file manifests
+    """
+    partition_dirs = ["*" for _ in DATASET_PARTITIONING.schema.names]
+
+    all_files = []
+    for proc_manifest_path in sorted(
+        glob(join(dataset_dir, *partition_dirs, MANIFEST_FILENAME))
+    ):
+        with open(proc_manifest_path, "r") as fid:
+            all_files.append(json_load(fid))
+
+    # e.g., the files being written, or left by a crashed job
+    incomplete_files = {
+        relpath(file_path, dataset_dir)
+        for file_path in glob(join(dataset_dir, *partition_dirs, DATASET_FILENAME))
+    } - {proc_file["path"] for proc_file in all_files}
+    if len(incomplete_files) > 0:
+        logger.warning(
+            f"Skipping {len(incomplete_files)} files without manifest in "
+            f"{dataset_dir}: {sorted(incomplete_files)}"
+        )
+
+    return all_files
+
+
+def collect_manifest(dataset_dir: str) -> dict:
+    """Collect the manifests of all files into the manifest of the dataset.
+    The change token is read before the file manifests, so a file completed
+    meanwhile leaves the manifest stale
+
+    Args:
+        dataset_dir (str): Dataset directory
+
+    Returns:
+        dict: manifest
+    """
+    changes = read_changes(dataset_dir)
+    all_files = read_file_manifests(dataset_dir)
+
+    return {
+        "version": MANIFEST_VERSION,
+        "changes": changes,
+        "num_files": len(all_files),
+        "num_rows": sum(proc_file["num_rows"] for proc_file in all_files),
+        "files": all_files,
+    }
+
+
+def update_manifest(dataset_dir: str):
+    """Write the manifest of the dataset, e.g., after a model run
+
+    Args:
+        dataset_dir (str): Dataset directory
+    """
+    write_json(join(dataset_dir, MANIFEST_FILENAME), collect_manifest(dataset_dir))
+
+
+def read_manifest(dataset_dir: str) -> dict or None:
+    """Read the manifest of the dataset
+
+    Args:
+        dataset_dir (str): Dataset directory
+
+    Returns:
+        dict or None: manifest, None if the dataset has no manifest
+    """
+    manifest_path = join(dataset_dir, MANIFEST_FILENAME)
+    if not exists(manifest_path):
+        return None
+
+    with open(manifest_path, "r") as fid:
+        manifest = json_load(fid)
+
+    if manifest["version"] != MANIFEST_VERSION:
+        raise Exception(
+            f"Dataset manifest version {manifest['version']} is not supported ..."
+        )
+
+    return manifest
+
+
+def open_dataset(dataset_dir: str) -> Dataset:
+    """Open the partitioned dataset, e.g., the readers can then use partition
+    pruning (e.g., filter=field("model_id") == "1") and column projection.
+    The files are taken from the manifest of the dataset. If it is stale
+    (e.g., files written by other jobs running at the same time, or crashed
+    before updating the manifest), the new file manifests are collected into
+    it first, while the partially written files are skipped. A dataset
+    without any manifest is discovered by pyarrow
+
+    Args:
+        dataset_dir (str): Dataset directory
+
+    Returns:
+        Dataset: pyarrow dataset
+    """
+    manifest = read_manifest(dataset_dir)
+    if manifest is None or manifest.get("changes") != read_changes(dataset_dir):
+        logger.info(f"Updating the manifest of {dataset_dir} ...")
+        manifest = collect_manifest(dataset_dir)
+        if manifest["num_files"] > 0:
+            try:
+                write_json(join(dataset_dir, MANIFEST_FILENAME), manifest)
+            except OSError:
+                # e.g., a read only dataset, the manifest is collected again
+                logger.warning(f"Not able to update the manifest of {dataset_dir}")
+
+    if manifest["num_files"] == 0:
+        return pyarrow_dataset(
+            dataset_dir, format="parquet", partitioning=DATASET_PARTITIONING
+        )
+
+    return pyarrow_dataset(
+        [join(dataset_dir, proc_file["path"]) for proc_file in manifest["files"]],
+        format="parquet",
+        partitioning=DATASET_PARTITIONING,
+        partition_base_dir=dataset_dir,
+    )
+
+
+def create_dataset_dir(dataset_dir: str, partition: dict):
+    """Create the directory of a file in the partitioned dataset
+
+    Args:
+        dataset_dir (str): Dataset directory
+        partition (dict): region, exp, model_id and ens of the file
+    """
+    makedirs(dirname(get_dataset_path(dataset_dir, partition)), exist_ok=True)
@@ -1,222 +1,364 @@
-from enum import IntEnum
 from logging import getLogger
-from random import sample as random_sample
-from random import uniform as random_uniform
 
-from mesa import Agent
-from numpy.random import choice as numpy_choice
+from numpy import (
+    arange,
+    array,
+    bincount,
+    concatenate,
+    copyto,
+    cumsum,
+    float32,
+    full,
+    iinfo,
+    int8,
+    int16,
+    int32,
+    int64,
+    ndarray,
+    repeat,
+    searchsorted,
+    tile,
+    unique,
+    zeros,
+)
+from numpy.random import Generator, default_rng
+from pandas import Categorical, DataFrame
 
-from process import CLINICAL_PARAMS, DEBUG_FLAG, INFECTED_NO_REPORT_RATIO
+from process import CLINICAL_PARAMS, SUMMARY_AGE_BANDS
 from process.model import State, Vaccine
-from process.model.utils import cal_infectiousness_profile, calculate_disease_days
+from process.model.utils import (
+    calculate_disease_days,
+    create_infectiousness_profile_table,
+    get_code_dtype,
+    load_columns,
+    save_columns,
+)
 
 logger = getLogger()
 
-"""
-class State(IntEnum):
-    SUSCEPTIBLE = 0
-    SEED_INFECTION = 1
-    INFECTED = 2
-    RECOVERED = 3
-    INFECTED_NO_REPORT = 4
+IMMS_STATUS = {
+    "nature_imms": Vaccine.NATURE,
+    "fully_imms": Vaccine.FULL,
+    "partial_imms": Vaccine.PARTIAL,
+    "no_imms": Vaccine.NO,
+}
 
+# the missing value used in the int16 timestep columns (e.g., infection_time)
+NO_TIMESTEP = -1
 
-class Vaccine(IntEnum):
-    NATURE = 3
-    FULL = 2
-    PARTIAL = 1
-    NO = 0
-"""
 
+class AgentsStore:
+    """Columnar (struct of arrays) store for all agents, where each column is
+    a NumPy array indexed by the agent row. An agent is a person, e.g., the
+    state and the disease timeline are shared by all diary locations of the
+    person, and the diary locations are the memberships of the person in the
+    CSR layout, e.g., the memberships of the agent row `i` are
+    `membership_offsets[i]:membership_offsets[i + 1]`, indexing the membership
+    columns (membership_agent, loc_type and location)
+    """
+
+    # columns updated while running the model, all others are immutable
+    MUTABLE_COLUMNS = ["state", "vaccine_status", "infection_time", "imms_timestep"]
 
-class Agents(Agent):
     def __init__(
         self,
-        unique_id,
-        person_attr,
-        model,
-        pos,
-        loc_type,
-        imms_status,
+        agents: DataFrame,
         days_buffer: float = 0.15,
+        rng: Generator or None = None,
     ):
-        super().__init__(unique_id, model)
-
-        self.unique_id = unique_id
-        self.age = person_attr["age"]
-        self.ethnicity = person_attr["ethnicity"]
-        self.gender = person_attr["gender"]
-        self.pos = pos
-        self.loc_type = loc_type
-        self.state = State.SUSCEPTIBLE
-        if imms_status == "nature_imms":
-            self.vaccine_status = Vaccine.NATURE
-        if imms_status == "fully_imms":
-            self.vaccine_status = Vaccine.FULL
-        elif imms_status == "partial_imms":
-            self.vaccine_status = Vaccine.PARTIAL
-        elif imms_status == "no_imms":
-            self.vaccine_status = Vaccine.NO
-
-        self.vaccine_efficiency_full = CLINICAL_PARAMS["vaccine_efficiency"]["full"]
-        self.vaccine_efficiency_partial = CLINICAL_PARAMS["vaccine_efficiency"][
-            "partial"
-        ]
-        self.infection_time = None
-        self.symptomatic_time = None
-        self.recovery_time = None
-        days_buffer = random_uniform(0.0, days_buffer)
+        """Create the agents store
+
+        Args:
+            agents (DataFrame): agents table (one row per person and diary
+                location), e.g., from create_agents_table
+            days_buffer (float, optional): The maximum buffer applied
+                to the disease days. Defaults to 0.15.
+            rng (Generator or None, optional): random number generator for
+                the disease days buffer, None for fresh entropy. Defaults to None.
+        """
+        # the memberships are ordered by person, and the agent row is the
+        # person code, e.g., the person of the agent row `i` is person_names[i]
+        memberships = agents.sort_values("id", kind="stable")
+        self.person_names, self.membership_agent = encode_column(
+            memberships["id"], dtype=int32
+        )
+        total_agents = len(self.person_names)
+        self.membership_offsets = concatenate(
+            [
+                zeros(1, dtype=int64),
+                cumsum(bincount(self.membership_agent, minlength=total_agents)),
+            ]
+        )
+
+        # categorical columns: the codes are indexed by membership (loc_type
+        # and location) or agent row, the names are indexed by code
+        self.loc_type_names, self.loc_type = encode_column(memberships["type"])
+        self.location_names, self.location = encode_column(
+            memberships["location"], dtype=int32
+        )
+
+        agents = memberships.iloc[self.membership_offsets[:-1]]
+        self.gender_names, self.gender = encode_column(agents["gender"])
+        self.ethnicity_names, self.ethnicity = encode_column(agents["ethnicity"])
+        self.age = agents["age"].values.astype(int16)
 
+        unknown_imms = ~agents["mmr"].isin(IMMS_STATUS)
+        if unknown_imms.any():
+            raise Exception(
+                f"Found unknown immunisation status: {agents['mmr'][unknown_imms].unique()}"
+            )
+        self.vaccine_status = (
+            agents["mmr"].map({k: int(v) for k, v in IMMS_STATUS.items()}).values
+        ).astype(int8)
+
+        self.state = full(total_agents, State.SUSCEPTIBLE, dtype=int8)
+        self.infection_time = full(total_agents, NO_TIMESTEP, dtype=int16)
+        self.imms_timestep = full(total_agents, NO_TIMESTEP, dtype=int16)
+
+        if rng is None:
+            rng = default_rng()
+
+        days_buffer = rng.uniform(0.0, days_buffer, total_agents)
         for days_type in [
             "incubation",
             "infectiousness",
             "symptom",
             "recovered",
         ]:
-            setattr(
-                self,
-                f"infection_to_{days_type}_days",
-                calculate_disease_days(
-                    CLINICAL_PARAMS[f"infection_to_{days_type}_days"], days_buffer
-                ),
+            proc_days = calculate_disease_days(
+                CLINICAL_PARAMS[f"infection_to_{days_type}_days"], days_buffer, rng
             )
+            if isinstance(proc_days, dict):
+                for proc_key in ["start", "end"]:
+                    setattr(
+                        self,
+                        f"infection_to_{days_type}_days_{proc_key}",
+                        proc_days[proc_key].astype(float32),
+                    )
+            else:
+                setattr(
+                    self, f"infection_to_{days_type}_days", proc_days.astype(float32)
+                )
 
-        self.infectiousness_profile = cal_infectiousness_profile(
-            start_t=self.infection_to_infectiousness_days["start"],
-            end_t=self.infection_to_infectiousness_days["end"],
-            alpha=9.0,
-            beta=0.5,
+        # the agents only keep the index to the shared profile table, e.g.,
+        # the infectiousness of the agent row `i` at delta_t is
+        # infectiousness_profile_table[infectiousness_profile[i], delta_t]
+        (
+            self.infectiousness_profile_table,
+            self.infectiousness_profile,
+        ) = create_infectiousness_profile_table(
+            self.infection_to_infectiousness_days_start,
+            self.infection_to_infectiousness_days_end,
         )
 
-    def step(self):
-
-        if self.state == State.SEED_INFECTION:
-            if self.model.timestep == self.infection_time:
-                self.state = State.INFECTED
-                if DEBUG_FLAG:
-                    logger.info(f"    * intial infection at {self.model.timestep}")
-
-        if self.state in [State.INFECTED, State.INFECTED_NO_REPORT]:
-
-            delta_t = self.model.timestep - self.infection_time
-
-            # --------------------------------------------
-            # Step 1: Check if the agent is recovered
-            # ---------------------------------------------
-            if delta_t > self.infection_to_recovered_days:
-                self.state = State.RECOVERED
-                return
-
-            # --------------------------------------------
-            # Step 2: Check if the agent is infectiousness,
-            #          if not, nothing will be done from here
-            # ---------------------------------------------
-            if (
-                delta_t < self.infection_to_infectiousness_days["start"]
-                or delta_t > self.infection_to_infectiousness_days["end"]
-            ):
-                return
-
-            # --------------------------------------------
-            # Step 3: Check if the agent has symptoms,
-            #          if so there is a chance he/she may stay at home,
-            # ---------------------------------------------
-            if self.model.stay_at_home_if_symptom["enable"]:
-                if (
-                    delta_t > self.infection_to_symptom_days["start"]
-                    or delta_t < self.infection_to_symptom_days["end"]
-                ):
-                    if numpy_choice(
-                        [True, False],
-                        p=[
-                            self.model.stay_at_home_if_symptom["percentage"],
-                            1.0 - self.model.stay_at_home_if_symptom["percentage"],
-                        ],
-                    ):
-                        return
-
-            # --------------------------------------------
-            # Step 4: Creating infectiousness profile
-            # ---------------------------------------------
-            if self.model.reproduction_weight[self.loc_type] is None:
-                return
-            try:
-                infectiousness_value = (
-                    self.infectiousness_profile[delta_t]
-                    * self.model.reproduction_weight[self.loc_type]
-                )
-            except KeyError:
-                infectiousness_value = 0.0
-
-            # --------------------------------------------
-            # Step 5: Getting all possible neighbors
-            # ---------------------------------------------
-            neighbors = self.model.grid.get_neighbors(
-                self.pos, 0.0, include_center=True
-            )
-            neighbors = random_sample(
-                neighbors, min([len(neighbors), int(infectiousness_value)])
+    def __len__(self) -> int:
+        return len(self.person_names)
+
+    def memberships(self, rows: ndarray) -> tuple:
+        """Obtain the memberships (diary locations) for a batch of agents,
+        e.g., all infectious agents in one go
+
+        Args:
+            rows (ndarray): agent rows
+
+        Returns:
+            tuple: the position of the agent (in rows) and the membership
+                for each membership of the agents
+        """
+        starts = self.membership_offsets[rows]
+        sizes = self.membership_offsets[rows + 1] - starts
+        source = repeat(arange(len(rows)), sizes)
+        return source, starts[source] + arange(len(source)) - repeat(
+            cumsum(sizes) - sizes, sizes
+        )
+
+    def members(self, column_name: str) -> ndarray:
+        """Obtain a mutable column as (ensemble member x agent), e.g., a single
+        run is one member
+
+        Args:
+            column_name (str): mutable column name, e.g., state
+
+        Returns:
+            ndarray: view of the column
+        """
+        return getattr(self, column_name).reshape(-1, len(self))
+
+    def snapshot(self) -> dict:
+        """Copy the mutable columns, e.g., as the baseline for ensemble members
+
+        Returns:
+            dict: column name and the copied values
+        """
+        return {
+            column_name: getattr(self, column_name).copy()
+            for column_name in self.MUTABLE_COLUMNS
+        }
+
+    def restore(self, snapshot: dict, ens_number: int or None = None):
+        """Restore the mutable columns (in place) from a snapshot
+
+        Args:
+            snapshot (dict): snapshot from AgentsStore.snapshot
+            ens_number (int or None, optional): Number of ensemble members, the
+                mutable columns become (ensemble member x agent) if it is set.
+                Defaults to None.
+        """
+        for column_name, column_values in snapshot.items():
+            if ens_number is not None:
+                column_values = tile(column_values, (ens_number, 1))
+            if getattr(self, column_name).shape == column_values.shape:
+                copyto(getattr(self, column_name), column_values)
+            else:
+                setattr(self, column_name, column_values.copy())
+
+    def save(self, agents_dir: str):
+        """Save all columns
+
+        Args:
+            agents_dir (str): directory to store the columns
+        """
+        save_columns(self.columns(), agents_dir)
+
+    @classmethod
+    def load(cls, agents_dir: str, mmap_mode: str or None = "r"):
+        """Load the columns saved by AgentsStore.save
+
+        Args:
+            agents_dir (str): directory storing the columns
+            mmap_mode (str or None, optional): memory-map mode. Defaults to "r".
+
+        Returns:
+            AgentsStore: agents store
+        """
+        return cls.from_columns(
+            load_columns(
+                agents_dir, mmap_mode=mmap_mode, mutable_columns=cls.MUTABLE_COLUMNS
             )
+        )
 
-            # --------------------------------------------
-            # Step 5: Infecting people if they are not vaccinated
-            # ---------------------------------------------
-            infected_neighbors = []
-            for neighbor in neighbors:
-
-                if neighbor.unique_id == self.unique_id:
-                    continue
-
-                if neighbor.state == State.SUSCEPTIBLE:
-
-                    if neighbor.vaccine_status == Vaccine.NO or (
-                        neighbor.imms_timestep is not None
-                        and neighbor.imms_timestep > self.model.timestep
-                    ):
-
-                        if numpy_choice(
-                            [True, False],
-                            p=[
-                                INFECTED_NO_REPORT_RATIO,
-                                1.0 - INFECTED_NO_REPORT_RATIO,
-                            ],
-                        ):
-                            neighbor.state = State.INFECTED_NO_REPORT
-                        else:
-                            neighbor.state = State.INFECTED
-                        neighbor.infection_time = self.model.timestep
-                        infected_neighbors.append(neighbor)
-                    elif neighbor.vaccine_status in [Vaccine.FULL, Vaccine.PARTIAL]:
-
-                        if neighbor.vaccine_status == Vaccine.FULL:
-                            proc_vaccine_efficiency = self.vaccine_efficiency_full
-                        else:
-                            proc_vaccine_efficiency = self.vaccine_efficiency_partial
-
-                        if numpy_choice(
-                            [True, False],
-                            p=[
-                                1.0 - proc_vaccine_efficiency,
-                                proc_vaccine_efficiency,
-                            ],
-                        ):
-
-                            if numpy_choice(
-                                [True, False],
-                                p=[
-                                    INFECTED_NO_REPORT_RATIO,
-                                    1.0 - INFECTED_NO_REPORT_RATIO,
-                                ],
-                            ):
-                                neighbor.state = State.INFECTED_NO_REPORT
-                            else:
-                                neighbor.state = State.INFECTED
-                            neighbor.infection_time = self.model.timestep
-                            infected_neighbors.append(neighbor)
-                    elif neighbor.vaccine_status == Vaccine.NATURE:
-                        continue
-
-            if len(infected_neighbors) > 0 and DEBUG_FLAG:
-                logger.info(
-                    f"    * {self.loc_type}: newly infected person: {len(infected_neighbors)}"
-                )
+    @classmethod
+    def from_columns(cls, columns: dict):
+        """Create the agents store from existing columns
+
+        Args:
+            columns (dict): column name and the array
+
+        Returns:
+            AgentsStore: agents store
+        """
+        agents_store = cls.__new__(cls)
+        for column_name, column_values in columns.items():
+            setattr(agents_store, column_name, column_values)
+        return agents_store
+
+    def columns(self) -> dict:
+        """Obtain all columns
+
+        Returns:
+            dict: column name and the array
+        """
+        return vars(self)
+
+    def encode(self, column: str, names: list) -> list:
+        """Obtain the codes for the names in a categorical column
+
+        Args:
+            column (str): categorical column, e.g., ethnicity
+            names (list): names to be encoded, e.g., ["Maori", "Asian"]
+
+        Returns:
+            list: codes for the names which present in the store
+        """
+        all_names = list(getattr(self, f"{column}_names"))
+        return [all_names.index(name) for name in names if name in all_names]
+
+    def summary_agents(self, group_names: list) -> ndarray or None:
+        """Obtain the agent of each row counted by the summary outputs, e.g.,
+        a loc_type split counts each membership of the agents (as an agent
+        is counted for every loc_type it belongs to)
+
+        Args:
+            group_names (list): groups, e.g., loc_type, age_band, ethnicity
+                or gender
+
+        Returns:
+            ndarray or None: agent row of each membership, None if each agent
+                is counted once
+        """
+        if "loc_type" in group_names:
+            return self.membership_agent
+        return None
+
+    def summary_groups(self, group_names: list) -> dict:
+        """Obtain the groups splitting the summary outputs, the codes are
+        indexed by the rows from AgentsStore.summary_agents
+
+        Args:
+            group_names (list): groups, e.g., loc_type, age_band, ethnicity
+                or gender
+
+        Returns:
+            dict: group name and the (codes, names) of the group
+        """
+        summary_agents = self.summary_agents(group_names)
+
+        groups = {}
+        for group_name in group_names:
+            if group_name == "loc_type":
+                codes = self.loc_type
+                names = list(self.loc_type_names)
+            elif group_name == "age_band":
+                codes = searchsorted(SUMMARY_AGE_BANDS, self.age, side="right") - 1
+                names = [
+                    f"{start}-{end - 1}"
+                    for start, end in zip(SUMMARY_AGE_BANDS[:-1], SUMMARY_AGE_BANDS[1:])
+                ] + [f"{SUMMARY_AGE_BANDS[-1]}+"]
+            elif group_name in ["ethnicity", "gender"]:
+                codes = getattr(self, group_name)
+                names = list(getattr(self, f"{group_name}_names"))
+            else:
+                raise Exception(f"Summary group {group_name} is not supported ...")
+            if summary_agents is not None and group_name != "loc_type":
+                # the codes of the agent are repeated for each membership
+                codes = codes[summary_agents]
+            groups[group_name] = (codes.astype(int32), names)
+        return groups
+
+    def decode_table(self) -> DataFrame:
+        """Obtain the decode table of the agent rows, e.g., for the AgentID
+        in the outputs
+
+        Returns:
+            DataFrame: AgentID (agent row), person_id, age, gender and ethnicity
+        """
+        return DataFrame(
+            {
+                "AgentID": arange(len(self), dtype=int32),
+                "person_id": self.person_names,
+                "age": self.age,
+                "gender": Categorical.from_codes(self.gender, self.gender_names),
+                "ethnicity": Categorical.from_codes(
+                    self.ethnicity, self.ethnicity_names
+                ),
+            }
+        )
+
+
+def encode_column(column_values, dtype=None) -> tuple:
+    """Encode a column to categorical codes
+
+    Args:
+        column_values (Series): values to be encoded
+        dtype (optional): dtype of the codes, None for the smallest dtype
+            holding all codes. Defaults to None.
+
+    Returns:
+        tuple: the names (indexed by code) and the codes (indexed by row)
+    """
+    names, codes = unique(array(column_values), return_inverse=True)
+    if dtype is None:
+        dtype = get_code_dtype(len(names))
+    elif len(names) > iinfo(dtype).max + 1:
+        raise Exception(f"Found {len(names)} codes, which do not fit in {dtype} ...")
+    return names, codes.astype(dtype)
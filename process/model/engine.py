@@ -0,0 +1,241 @@
+from logging import getLogger
+
+from numpy import (
+    arange,
+    array,
+    bincount,
+    concatenate,
+    floor,
+    int64,
+    isnan,
+    nan,
+    ndarray,
+    searchsorted,
+    unique,
+)
+from numpy import where as numpy_where
+from numpy import zeros
+
+from process import CLINICAL_PARAMS, DEBUG_FLAG, INFECTED_NO_REPORT_RATIO
+from process.model import State, Vaccine
+from process.model.location import LocationIndex
+from process.model.streams import RandomStreams
+
+logger = getLogger()
+
+
+def obtain_reproduction_weight(reproduction_weight: dict, loc_type_names) -> ndarray:
+    """Obtain the reproduction weight for each loc_type code
+
+    Args:
+        reproduction_weight (dict): reproduction weight for each social setting
+        loc_type_names (list): loc_type names, indexed by loc_type code
+
+    Returns:
+        ndarray: reproduction weight (nan if the setting does not transmit)
+    """
+    return array(
+        [
+            (
+                nan
+                if reproduction_weight[loc_type] is None
+                else reproduction_weight[loc_type]
+            )
+            for loc_type in loc_type_names
+        ]
+    )
+
+
+def infection_probability(
+    vaccine_status: ndarray, imms_timestep: ndarray, timestep: int
+) -> ndarray:
+    """Obtain the probability of being infected for a contact
+
+    Args:
+        vaccine_status (ndarray): vaccine status of the contacts
+        imms_timestep (ndarray): timestep when the vaccination takes effect
+        timestep (int): current timestep
+
+    Returns:
+        ndarray: infection probability
+    """
+    probability = zeros(len(vaccine_status))
+    probability[vaccine_status == Vaccine.FULL] = (
+        1.0 - CLINICAL_PARAMS["vaccine_efficiency"]["full"]
+    )
+    probability[vaccine_status == Vaccine.PARTIAL] = (
+        1.0 - CLINICAL_PARAMS["vaccine_efficiency"]["partial"]
+    )
+    probability[(vaccine_status == Vaccine.NO) | (imms_timestep > timestep)] = 1.0
+    return probability
+
+
+def sample_contacts(
+    location_index: LocationIndex,
+    random: RandomStreams,
+    location_codes: ndarray,
+    sample_sizes: ndarray,
+    members: ndarray,
+) -> tuple:
+    """Sample the contacts at the locations, e.g., in a batched run the
+    contacts of each ensemble member are drawn from its own stream
+
+    Args:
+        location_index (LocationIndex): location index
+        random (RandomStreams): random number streams
+        location_codes (ndarray): location code for each sample
+        sample_sizes (ndarray): number of contacts for each sample
+        members (ndarray): ensemble member of each sample, the samples must be
+            ordered by member
+
+    Returns:
+        tuple: the sample position and the sampled member (agent row)
+    """
+    if len(random) == 1:
+        return location_index.sample_members(
+            location_codes, sample_sizes, random.generator("contacts")
+        )
+
+    all_source = []
+    all_neighbors = []
+    bounds = searchsorted(members, arange(len(random) + 1))
+    for member_i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        source, neighbors = location_index.sample_members(
+            location_codes[start:end],
+            sample_sizes[start:end],
+            random.generator("contacts", member_i),
+        )
+        all_source.append(source + start)
+        all_neighbors.append(neighbors)
+    return concatenate(all_source), concatenate(all_neighbors)
+
+
+def transmission_step(model, timestep: int):
+    """Run one timestep for all agents with whole-array operations. The mutable
+    columns can be (agent) or (ensemble member x agent) arrays, and the agents
+    are indexed over the flattened array, e.g., member * total_agents + row,
+    so all ensemble members run in one batch sharing the location index
+    and the profile table. An agent (person) transmits at all its memberships
+    (diary locations). The agents stay ordered by ensemble member, so each
+    member draws its random numbers as in a single run
+
+    Args:
+        model (Epimodel_esr): model to be updated
+        timestep (int): current timestep
+    """
+    agents_store = model.agents_store
+    total_agents = len(agents_store)
+    state = agents_store.state.reshape(-1)
+    infection_time = agents_store.infection_time.reshape(-1)
+
+    # --------------------------------------------
+    # Step 0: Seeded agents are infected
+    # ---------------------------------------------
+    seeded = model.schedule.activate(timestep)
+    state[seeded] = State.INFECTED
+    if DEBUG_FLAG and len(seeded) > 0:
+        logger.info(f"    * intial infection at {timestep}: {len(seeded)}")
+
+    agents = model.schedule.shuffled(model.random, total_agents)
+    rows = agents % total_agents
+    delta_t = timestep - infection_time[agents].astype(int64)
+
+    # --------------------------------------------
+    # Step 1: Check if the agent is recovered
+    # ---------------------------------------------
+    recovered = delta_t > agents_store.infection_to_recovered_days[rows]
+    state[agents[recovered]] = State.RECOVERED
+    model.schedule.remove(agents[recovered])
+    agents, rows, delta_t = agents[~recovered], rows[~recovered], delta_t[~recovered]
+
+    # --------------------------------------------
+    # Step 2: Check if the agent is infectiousness,
+    #          if not, nothing will be done from here
+    # ---------------------------------------------
+    infectious = (
+        delta_t >= agents_store.infection_to_infectiousness_days_start[rows]
+    ) & (delta_t <= agents_store.infection_to_infectiousness_days_end[rows])
+    agents, rows, delta_t = agents[infectious], rows[infectious], delta_t[infectious]
+
+    # --------------------------------------------
+    # Step 3: Check if the agent has symptoms,
+    #          if so there is a chance he/she may stay at home,
+    # ---------------------------------------------
+    if model.stay_at_home_if_symptom["enable"]:
+        symptom = (delta_t > agents_store.infection_to_symptom_days_start[rows]) | (
+            delta_t < agents_store.infection_to_symptom_days_end[rows]
+        )
+        transmit = ~(
+            symptom
+            & (
+                model.random.uniform_members("stay_at_home", agents // total_agents)
+                < model.stay_at_home_if_symptom["percentage"]
+            )
+        )
+        agents, rows, delta_t = agents[transmit], rows[transmit], delta_t[transmit]
+
+    # --------------------------------------------
+    # Step 4: Creating infectiousness profile
+    #   (for each membership of the agents)
+    # ---------------------------------------------
+    source, memberships = agents_store.memberships(rows)
+    reproduction_weight = obtain_reproduction_weight(
+        model.reproduction_weight, agents_store.loc_type_names
+    )[agents_store.loc_type[memberships]]
+    transmit = ~isnan(reproduction_weight)
+    source, memberships = source[transmit], memberships[transmit]
+    infectiousness_value = (
+        agents_store.infectiousness_profile_table[
+            agents_store.infectiousness_profile[rows[source]], delta_t[source]
+        ]
+        * reproduction_weight[transmit]
+    )
+
+    # --------------------------------------------
+    # Step 5: Getting all possible neighbors
+    #   (from the same ensemble member)
+    # ---------------------------------------------
+    contacts, neighbors = sample_contacts(
+        model.location_index,
+        model.random,
+        agents_store.location[memberships],
+        floor(infectiousness_value).astype(int64),
+        agents[source] // total_agents,
+    )
+    source = source[contacts]
+    neighbors = neighbors + (agents - rows)[source]
+    susceptible = (neighbors != agents[source]) & (
+        state[neighbors] == State.SUSCEPTIBLE
+    )
+    neighbors, contacts = neighbors[susceptible], contacts[susceptible]
+
+    # --------------------------------------------
+    # Step 6: Infecting people if they are not vaccinated
+    # ---------------------------------------------
+    infected = model.random.uniform_members(
+        "infection", neighbors // total_agents
+    ) < infection_probability(
+        agents_store.vaccine_status.reshape(-1)[neighbors],
+        agents_store.imms_timestep.reshape(-1)[neighbors],
+        timestep,
+    )
+    infected_neighbors, first_infected = unique(neighbors[infected], return_index=True)
+    state[infected_neighbors] = numpy_where(
+        model.random.uniform_members("no_report", infected_neighbors // total_agents)
+        < INFECTED_NO_REPORT_RATIO,
+        State.INFECTED_NO_REPORT,
+        State.INFECTED,
+    )
+    infection_time[infected_neighbors] = timestep
+    model.schedule.add(infected_neighbors)
+
+    if DEBUG_FLAG and len(infected_neighbors) > 0:
+        newly_infected = bincount(
+            agents_store.loc_type[memberships[contacts[infected][first_infected]]],
+            minlength=len(agents_store.loc_type_names),
+        )
+        for loc_type_code in arange(len(newly_infected)).compress(newly_infected):
+            logger.info(
+                f"    * {agents_store.loc_type_names[loc_type_code]}: "
+                f"newly infected person: {newly_infected[loc_type_code]}"
+            )
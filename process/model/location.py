@@ -0,0 +1,154 @@
+from numpy import (
+    arange,
+    argsort,
+    bincount,
+    concatenate,
+    cumsum,
+    int32,
+    int64,
+    lexsort,
+    minimum,
+    ndarray,
+    repeat,
+    where,
+    zeros,
+)
+from numpy.random import Generator
+
+from process.model.utils import load_columns, save_columns
+
+
+class LocationIndex:
+    """Location to members index in the CSR layout, e.g., the members (agent rows)
+    of the location code `i` are `members[offsets[i]:offsets[i + 1]]`
+    """
+
+    def __init__(
+        self,
+        location: ndarray,
+        total_locations: int,
+        membership_agent: ndarray or None = None,
+    ):
+        """Create the location index
+
+        Args:
+            location (ndarray): location code for each membership
+            total_locations (int): total number of location codes
+            membership_agent (ndarray or None, optional): agent row for each
+                membership, None if the memberships are the agent rows.
+                Defaults to None.
+        """
+        self.members = argsort(location, kind="stable").astype(int32)
+        if membership_agent is not None:
+            self.members = membership_agent[self.members].astype(int32)
+        self.offsets = concatenate(
+            [
+                zeros(1, dtype=int64),
+                cumsum(bincount(location, minlength=total_locations), dtype=int64),
+            ]
+        )
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def save(self, index_dir: str):
+        """Save the index
+
+        Args:
+            index_dir (str): directory to store the index
+        """
+        save_columns(self.columns(), index_dir)
+
+    @classmethod
+    def load(cls, index_dir: str, mmap_mode: str or None = "r"):
+        """Load the index saved by LocationIndex.save
+
+        Args:
+            index_dir (str): directory storing the index
+            mmap_mode (str or None, optional): memory-map mode. Defaults to "r".
+
+        Returns:
+            LocationIndex: location index
+        """
+        return cls.from_columns(load_columns(index_dir, mmap_mode=mmap_mode))
+
+    @classmethod
+    def from_columns(cls, columns: dict):
+        """Create the index from existing columns
+
+        Args:
+            columns (dict): members and offsets
+
+        Returns:
+            LocationIndex: location index
+        """
+        location_index = cls.__new__(cls)
+        location_index.members = columns["members"]
+        location_index.offsets = columns["offsets"]
+        return location_index
+
+    def columns(self) -> dict:
+        """Obtain all columns
+
+        Returns:
+            dict: members and offsets
+        """
+        return {"members": self.members, "offsets": self.offsets}
+
+    def sizes(self, location_codes: ndarray) -> ndarray:
+        """Obtain the number of members for the locations
+
+        Args:
+            location_codes (ndarray): location codes
+
+        Returns:
+            ndarray: number of members
+        """
+        return self.offsets[location_codes + 1] - self.offsets[location_codes]
+
+    def sample_members(
+        self, location_codes: ndarray, sample_sizes: ndarray, rng: Generator
+    ) -> tuple:
+        """Sample members (without replacement) for a batch of locations, e.g.,
+        the contacts of all infectious agents in one go
+
+        Args:
+            location_codes (ndarray): location code for each sample
+            sample_sizes (ndarray): number of members to be drawn for each sample,
+                capped by the number of members in the location
+            rng (Generator): random number generator
+
+        Returns:
+            tuple: the sample position (e.g., the infectious agent) and
+                the sampled member (agent row)
+        """
+        group_sizes = self.sizes(location_codes)
+        sample_sizes = minimum(sample_sizes, group_sizes)
+
+        source = repeat(arange(len(location_codes)), sample_sizes)
+        group_sizes = group_sizes[source]
+
+        # a sample takes all members if it is as large as the location,
+        # otherwise members are drawn with replacement and the duplicates
+        # within the same sample are redrawn until all members are distinct
+        rank = arange(len(source)) - repeat(
+            cumsum(sample_sizes) - sample_sizes, sample_sizes
+        )
+        partial = sample_sizes[source] < group_sizes
+        position = where(
+            partial, (rng.random(len(source)) * group_sizes).astype(int64), rank
+        )
+
+        while True:
+            order = lexsort((position, source))
+            duplicated = zeros(len(source), dtype=bool)
+            duplicated[order[1:]] = (source[order[1:]] == source[order[:-1]]) & (
+                position[order[1:]] == position[order[:-1]]
+            )
+            if not duplicated.any():
+                break
+            position[duplicated] = (
+                rng.random(duplicated.sum()) * group_sizes[duplicated]
+            ).astype(int64)
+
+        return source, self.members[self.offsets[location_codes][source] + position]
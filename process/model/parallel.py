@@ -0,0 +1,112 @@
+from multiprocessing.shared_memory import SharedMemory
+
+from numpy import ndarray
+
+from process.model.disease import AgentsStore
+from process.model.location import LocationIndex
+from process.model.wrapper import Epimodel_esr
+
+
+class SharedModel:
+    """The immutable population structure of a model in
+    multiprocessing.shared_memory, so workers on one node use one copy
+    """
+
+    def __init__(self, model: Epimodel_esr):
+        """Copy the immutable arrays (and the baseline of the mutable columns)
+        of the model into shared memory
+
+        Args:
+            model (Epimodel_esr): model, the baseline must be created
+                with Epimodel_esr.snapshot
+        """
+        self.shared_memory = []
+        self.spec = {
+            "agents": {},
+            "location_index": {},
+            "baseline": {},
+            "reproduction_weight": model.reproduction_weight,
+        }
+
+        for column_name, column_values in model.agents_store.columns().items():
+            if column_name in AgentsStore.MUTABLE_COLUMNS:
+                continue
+            self.spec["agents"][column_name] = self.share(column_values)
+
+        for column_name, column_values in model.location_index.columns().items():
+            self.spec["location_index"][column_name] = self.share(column_values)
+
+        for column_name, column_values in model.baseline.items():
+            self.spec["baseline"][column_name] = self.share(column_values)
+
+    def share(self, column_values: ndarray) -> tuple:
+        """Copy an array into shared memory
+
+        Args:
+            column_values (ndarray): array to be shared
+
+        Returns:
+            tuple: shared memory name, shape and dtype of the array
+        """
+        shared_memory = SharedMemory(create=True, size=max(1, column_values.nbytes))
+        ndarray(
+            column_values.shape, dtype=column_values.dtype, buffer=shared_memory.buf
+        )[:] = column_values
+        self.shared_memory.append(shared_memory)
+        return (shared_memory.name, column_values.shape, column_values.dtype.str)
+
+    def close(self):
+        """Release the shared memory"""
+        for shared_memory in self.shared_memory:
+            shared_memory.close()
+            shared_memory.unlink()
+        self.shared_memory = []
+
+
+def attach_model(spec: dict) -> tuple:
+    """Create a model (e.g., in a worker) from the arrays in shared memory.
+    The immutable arrays are read only views of the shared memory, and only
+    the mutable columns are private to the worker
+
+    Args:
+        spec (dict): SharedModel.spec
+
+    Returns:
+        tuple: the model and the attached shared memory, which must be kept
+            alive while the model is used
+    """
+    attached = []
+
+    def _attach(column_spec: tuple) -> ndarray:
+        name, shape, dtype = column_spec
+        shared_memory = SharedMemory(name=name)
+        attached.append(shared_memory)
+        column_values = ndarray(shape, dtype=dtype, buffer=shared_memory.buf)
+        column_values.flags.writeable = False
+        return column_values
+
+    baseline = {
+        column_name: _attach(column_spec)
+        for column_name, column_spec in spec["baseline"].items()
+    }
+
+    agents_columns = {
+        column_name: _attach(column_spec)
+        for column_name, column_spec in spec["agents"].items()
+    }
+    for column_name, column_values in baseline.items():
+        agents_columns[column_name] = column_values.copy()
+
+    model = Epimodel_esr.from_columns(
+        AgentsStore.from_columns(agents_columns),
+        LocationIndex.from_columns(
+            {
+                column_name: _attach(column_spec)
+                for column_name, column_spec in spec["location_index"].items()
+            }
+        ),
+        spec["reproduction_weight"],
+    )
+    model.baseline = baseline
+
+    return model, attached
@@ -0,0 +1,94 @@
+from numpy import argsort, concatenate, int64, isin, ndarray, searchsorted
+
+from process.model import State
+from process.model.streams import RandomStreams
+
+
+class ActiveSetScheduler:
+    """Scheduler only visiting the active agents, e.g., the SEED_INFECTION agents
+    (indexed by infection_time) and the INFECTED/INFECTED_NO_REPORT agents.
+    The agents are indexed over the flattened (ensemble member x agent) state
+    """
+
+    def __init__(self):
+        self.seed_rows = ndarray(0, dtype=int64)
+        self.seed_times = ndarray(0, dtype=int64)
+        self.active = ndarray(0, dtype=int64)
+
+    def __len__(self) -> int:
+        return len(self.active)
+
+    def build(self, agents_store):
+        """Build the active set from the agents state
+
+        Args:
+            agents_store (AgentsStore): agents to be scheduled
+        """
+        state = agents_store.state.reshape(-1)
+        seed_rows = (state == State.SEED_INFECTION).nonzero()[0]
+        seed_times = agents_store.infection_time.reshape(-1)[seed_rows].astype(int64)
+        order = argsort(seed_times, kind="stable")
+        self.seed_rows = seed_rows[order]
+        self.seed_times = seed_times[order]
+
+        active = isin(state, [State.INFECTED, State.INFECTED_NO_REPORT])
+        self.active = active.nonzero()[0]
+
+    def activate(self, timestep: int) -> ndarray:
+        """Move the agents seeded at the timestep into the active set
+
+        Args:
+            timestep (int): current timestep
+
+        Returns:
+            ndarray: activated agents (rows)
+        """
+        start, end = searchsorted(self.seed_times, [timestep, timestep + 1])
+        activated = self.seed_rows[start:end]
+        self.add(activated)
+        return activated
+
+    def add(self, rows: ndarray):
+        """Add agents (e.g., newly infected) to the active set
+
+        Args:
+            rows (ndarray): agent rows
+        """
+        self.active = concatenate([self.active, rows])
+
+    def remove(self, rows: ndarray):
+        """Remove agents (e.g., recovered) from the active set
+
+        Args:
+            rows (ndarray): agent rows
+        """
+        self.active = self.active[~isin(self.active, rows)]
+
+    def shuffled(self, random: RandomStreams, total_agents: int) -> ndarray:
+        """Obtain the active agents in a random activation order, e.g., in a
+        batched run the agents are ordered by ensemble member and each member
+        is shuffled with its own stream
+
+        Args:
+            random (RandomStreams): random number streams
+            total_agents (int): number of agents in one ensemble member
+
+        Returns:
+            ndarray: agent rows
+        """
+        if len(random) == 1:
+            return self.active[
+                random.generator("schedule").permutation(len(self.active))
+            ]
+
+        # the agents of a member keep the order of a single run
+        active = self.active[argsort(self.active // total_agents, kind="stable")]
+        bounds = searchsorted(active // total_agents, range(len(random) + 1))
+        return concatenate(
+            [
+                active[start:end][
+                    random.generator("schedule", member_i).permutation(end - start)
+                ]
+                for member_i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))
+            ]
+        )
@@ -0,0 +1,307 @@
+from datetime import datetime
+from queue import Queue
+from threading import Thread
+
+from numpy import (
+    arange,
+    bincount,
+    full,
+    int8,
+    int16,
+    int32,
+    ndarray,
+    prod,
+    repeat,
+    stack,
+    tile,
+    zeros,
+)
+from pyarrow import DictionaryArray, Table, array, concat_tables, field, schema
+from pyarrow import int8 as pyarrow_int8
+from pyarrow import int16 as pyarrow_int16
+from pyarrow import int32 as pyarrow_int32
+from pyarrow.parquet import ParquetWriter
+from pyarrow.parquet import write_table as parquet_write_table
+
+from process.model import State
+from process.model.utils import create_newly_increased_case
+
+# the initial timestep (%Y%m%d) is kept in the file metadata, the Step column
+# only stores the (int16) step
+OUTPUT_TIMESTEP_KEY = b"intital_timestep"
+
+
+class OutputSink:
+    """Model output written while the simulation runs, e.g., for each
+    ensemble member:
+        - the raw (per agent) output: the steps are appended to a Parquet file
+          in row groups (of a bounded number of rows), e.g., Step (int16),
+          AgentID (int32 agent row, decoded with AgentsStore.decode_table),
+          State and State_new_{state} (the first step an agent enters the state)
+        - the summary output: the number of new and prevalent agents for
+          each step and state, optionally split by groups (e.g., age band)
+    The outputs are built and written by a background thread, so the
+    output I/O overlaps with the simulation
+    """
+
+    def __init__(
+        self,
+        total_agents: int,
+        intital_timestep: datetime,
+        output_paths: list or None = None,
+        summary_paths: list or None = None,
+        summary_groups: dict or None = None,
+        summary_agents: ndarray or None = None,
+        max_queued_steps: int = 4,
+        row_group_rows: int = 1048576,
+    ):
+        """Open the output files
+
+        Args:
+            total_agents (int): number of agents
+            intital_timestep (datetime): the first timestep for the model
+            output_paths (list or None, optional): raw output path of each
+                ensemble member, None if the raw outputs are not written.
+                Defaults to None.
+            summary_paths (list or None, optional): summary output path of each
+                ensemble member, None if the summary outputs are not written.
+                Defaults to None.
+            summary_groups (dict or None, optional): groups splitting the
+                summary outputs, e.g., from AgentsStore.summary_groups, None
+                for no groups. Defaults to None.
+            summary_agents (ndarray or None, optional): agent of each row
+                counted by the summary outputs, e.g., from
+                AgentsStore.summary_agents to count each membership, None to
+                count each agent once. Defaults to None.
+            max_queued_steps (int, optional): steps waiting for the
+                background thread before OutputSink.write blocks. Defaults to 4.
+            row_group_rows (int, optional): rows (e.g., steps x agents)
+                written at once as a row group. Defaults to 1048576.
+        """
+        self.ens_number = len(
+            output_paths if output_paths is not None else summary_paths
+        )
+        self.metadata = {OUTPUT_TIMESTEP_KEY: intital_timestep.strftime("%Y%m%d")}
+        self.state_list = [
+            proc_state for proc_state in State if proc_state != State.SUSCEPTIBLE
+        ]
+        self.entered = zeros(
+            (self.ens_number, len(self.state_list), total_agents), dtype=bool
+        )
+
+        self.writers = []
+        if output_paths is not None:
+            self.agent_ids = arange(total_agents, dtype=int32)
+            self.schema = schema(
+                [
+                    field("Step", pyarrow_int16()),
+                    field("AgentID", pyarrow_int32()),
+                    field("State", pyarrow_int8()),
+                ]
+                + [
+                    field(f"State_new_{proc_state}", pyarrow_int8())
+                    for proc_state in self.state_list
+                ],
+                metadata=self.metadata,
+            )
+            self.writers = [
+                ParquetWriter(output_path, self.schema) for output_path in output_paths
+            ]
+            self.row_group_steps = max(1, row_group_rows // max(1, total_agents))
+            self.pending = [[] for _ in output_paths]
+
+        self.summary_paths = summary_paths
+        if summary_paths is not None:
+            if summary_groups is None:
+                summary_groups = {}
+
+            # the groups are combined into one code for each agent
+            self.summary_groups = summary_groups
+            self.group_sizes = [len(names) for _, names in summary_groups.values()]
+            self.summary_agents = summary_agents
+            self.group = zeros(
+                total_agents if summary_agents is None else len(summary_agents),
+                dtype=int32,
+            )
+            for codes, names in summary_groups.values():
+                self.group = self.group * len(names) + codes
+            self.summary_steps = []
+            self.summary_counts = [[] for _ in summary_paths]
+
+        self.error = None
+        self.queue = Queue(maxsize=max_queued_steps)
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, step: int, state: ndarray):
+        """Queue the agents state of a step to be written
+
+        Args:
+            step (int): current step
+            state (ndarray): agents state, (agent) or (ensemble member x agent)
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((step, state.reshape(self.ens_number, -1).copy()))
+
+    def run(self):
+        """Write the queued steps (in the background thread)"""
+        while True:
+            proc_item = self.queue.get()
+            if proc_item is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.write_step(*proc_item)
+            except Exception as error:
+                self.error = error
+
+    def write_step(self, step: int, state: ndarray):
+        """Write one step of all ensemble members
+
+        Args:
+            step (int): current step
+            state (ndarray): agents state (ensemble member x agent)
+        """
+        if self.summary_paths is not None:
+            self.summary_steps.append(step)
+
+        for member_i in range(self.ens_number):
+            newly_entered = create_newly_increased_case(
+                state[member_i], step, self.state_list, self.entered[member_i]
+            )
+
+            if len(self.writers) > 0:
+                self.write_raw(member_i, step, state[member_i], newly_entered)
+
+            if self.summary_paths is not None:
+                self.summary_counts[member_i].append(
+                    self.count(state[member_i], newly_entered)
+                )
+
+    def write_raw(self, member_i: int, step: int, state: ndarray, newly_entered: dict):
+        """Append one step to the raw output of an ensemble member
+
+        Args:
+            member_i (int): ensemble member
+            step (int): current step
+            state (ndarray): agents state
+            newly_entered (dict): agents newly entering each state
+        """
+        columns = {
+            "Step": full(len(state), step, dtype=int16),
+            "AgentID": self.agent_ids,
+            "State": state.astype(int8),
+        }
+        for proc_state in self.state_list:
+            columns[f"State_new_{proc_state}"] = newly_entered[proc_state].astype(int8)
+
+        self.pending[member_i].append(Table.from_pydict(columns, schema=self.schema))
+        if len(self.pending[member_i]) >= self.row_group_steps:
+            self.flush(member_i)
+
+    def count(self, state: ndarray, newly_entered: dict) -> ndarray:
+        """Count the new and prevalent agents of each state and group
+
+        Args:
+            state (ndarray): agents state
+            newly_entered (dict): agents newly entering each state
+
+        Returns:
+            ndarray: counts (new/prevalent x state x group)
+        """
+        if self.summary_agents is not None:
+            state = state[self.summary_agents]
+            newly_entered = {
+                proc_state: proc_entered[self.summary_agents]
+                for proc_state, proc_entered in newly_entered.items()
+            }
+
+        total_groups = int(prod(self.group_sizes))
+        return stack(
+            [
+                [
+                    bincount(
+                        self.group[newly_entered[proc_state]], minlength=total_groups
+                    )
+                    for proc_state in self.state_list
+                ],
+                [
+                    bincount(self.group[state == proc_state], minlength=total_groups)
+                    for proc_state in self.state_list
+                ],
+            ]
+        ).astype(int32)
+
+    def flush(self, member_i: int):
+        """Write the pending steps of an ensemble member as one row group
+
+        Args:
+            member_i (int): ensemble member
+        """
+        if len(self.pending[member_i]) > 0:
+            self.writers[member_i].write_table(
+                concat_tables(self.pending[member_i]).combine_chunks(),
+                row_group_size=sum(len(table) for table in self.pending[member_i]),
+            )
+            self.pending[member_i] = []
+
+    def write_summary(self, member_i: int):
+        """Write the summary output of an ensemble member, e.g., Step, State,
+        the groups, new and prevalent
+
+        Args:
+            member_i (int): ensemble member
+        """
+        counts = stack(self.summary_counts[member_i])
+        total_steps, _, total_states, total_groups = counts.shape
+
+        columns = {
+            "Step": repeat(self.summary_steps, total_states * total_groups).astype(
+                int16
+            ),
+            "State": tile(repeat(self.state_list, total_groups), total_steps).astype(
+                int8
+            ),
+        }
+        group_codes = arange(total_groups)
+        for group_name, group_size in reversed(
+            list(zip(self.summary_groups, self.group_sizes))
+        ):
+            columns[group_name] = DictionaryArray.from_arrays(
+                tile(group_codes % group_size, total_steps * total_states).astype(
+                    int32
+                ),
+                array(self.summary_groups[group_name][1]),
+            )
+            group_codes = group_codes // group_size
+        columns["new"] = counts[:, 0].reshape(-1)
+        columns["prevalent"] = counts[:, 1].reshape(-1)
+
+        summary = Table.from_pydict(
+            {
+                column_name: columns[column_name]
+                for column_name in ["Step", "State"]
+                + list(self.summary_groups)
+                + ["new", "prevalent"]
+            }
+        )
+        parquet_write_table(
+            summary.replace_schema_metadata(self.metadata),
+            self.summary_paths[member_i],
+        )
+
+    def close(self):
+        """Finish writing the queued steps and close the output files"""
+        self.queue.put(None)
+        self.thread.join()
+        for member_i, writer in enumerate(self.writers):
+            if self.error is None:
+                self.flush(member_i)
+            writer.close()
+        if self.error is None and self.summary_paths is not None:
+            for member_i in range(self.ens_number):
+                self.write_summary(member_i)
+        if self.error is not None:
+            raise self.error
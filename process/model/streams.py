@@ -0,0 +1,133 @@
+from numpy import bincount, concatenate, ndarray
+from numpy.random import Generator, SeedSequence, default_rng
+
+# each decision type draws from its own stream, so e.g., changing the
+# stay-at-home measure does not shift the random numbers of the infections
+DECISION_TYPES = [
+    "disease_days",
+    "initial_infection",
+    "vaccination",
+    "schedule",
+    "stay_at_home",
+    "contacts",
+    "infection",
+    "no_report",
+]
+
+
+class RandomStreams:
+    """Seeded random number streams, one numpy Generator per decision type
+    (and per ensemble member in a batched run, so a member draws the same
+    random numbers as in a single run). The uniforms for the per-agent
+    decisions (e.g., the stay-at-home, infection and no-report checks) are
+    pre-drawn in large blocks, so a step only slices the block instead of
+    calling the generator for every decision
+    """
+
+    def __init__(
+        self,
+        seed: SeedSequence or int or list or None = None,
+        block_size: int = 65536,
+    ):
+        """Create the random number streams
+
+        Args:
+            seed (SeedSequence or int or list or None, optional): seed, None
+                for fresh entropy, or a list with the seed of each ensemble
+                member in a batched run. Defaults to None.
+            block_size (int, optional): number of uniforms pre-drawn at once
+                for each decision type. Defaults to 65536.
+        """
+        all_seeds = seed if isinstance(seed, list) else [seed]
+
+        self.block_size = block_size
+        self.generators = []
+        for member_seed in all_seeds:
+            if not isinstance(member_seed, SeedSequence):
+                member_seed = SeedSequence(member_seed)
+            self.generators.append(
+                {
+                    decision_type: default_rng(decision_seed)
+                    for decision_type, decision_seed in zip(
+                        DECISION_TYPES, member_seed.spawn(len(DECISION_TYPES))
+                    )
+                }
+            )
+        self.blocks = [
+            {decision_type: ndarray(0) for decision_type in DECISION_TYPES}
+            for _ in all_seeds
+        ]
+        self.positions = [
+            {decision_type: 0 for decision_type in DECISION_TYPES} for _ in all_seeds
+        ]
+
+    def __len__(self) -> int:
+        return len(self.generators)
+
+    def generator(self, decision_type: str, member_i: int = 0) -> Generator:
+        """Obtain the generator of a decision type, e.g., for the draws
+        which are not uniforms (sampling, permutations etc.)
+
+        Args:
+            decision_type (str): decision type, e.g., contacts
+            member_i (int, optional): ensemble member in a batched run.
+                Defaults to 0.
+
+        Returns:
+            Generator: random number generator
+        """
+        return self.generators[member_i][decision_type]
+
+    def uniform(self, decision_type: str, size: int, member_i: int = 0) -> ndarray:
+        """Obtain uniforms in [0, 1) from the pre-drawn block of a decision type
+
+        Args:
+            decision_type (str): decision type, e.g., infection
+            size (int): number of uniforms
+            member_i (int, optional): ensemble member in a batched run.
+                Defaults to 0.
+
+        Returns:
+            ndarray: uniforms
+        """
+        block = self.blocks[member_i][decision_type]
+        position = self.positions[member_i][decision_type]
+
+        if position + size > len(block):
+            block = concatenate(
+                [
+                    block[position:],
+                    self.generators[member_i][decision_type].random(
+                        max(self.block_size, size)
+                    ),
+                ]
+            )
+            position = 0
+            self.blocks[member_i][decision_type] = block
+
+        self.positions[member_i][decision_type] = position + size
+        return block[position : position + size]
+
+    def uniform_members(self, decision_type: str, members: ndarray) -> ndarray:
+        """Obtain uniforms for a batch of decisions, each drawn from the
+        stream of its ensemble member
+
+        Args:
+            decision_type (str): decision type, e.g., infection
+            members (ndarray): ensemble member of each decision, the decisions
+                must be ordered by member
+
+        Returns:
+            ndarray: uniforms
+        """
+        if len(self) == 1:
+            return self.uniform(decision_type, len(members))
+
+        return concatenate(
+            [
+                self.uniform(decision_type, member_size, member_i=member_i)
+                for member_i, member_size in enumerate(
+                    bincount(members, minlength=len(self))
+                )
+            ]
+        )
@@ -1,56 +1,136 @@
 from datetime import datetime
-from random import sample as random_sample
-from random import uniform as random_uniform
-
+from glob import glob
+from os import makedirs
+from os.path import basename, join
+from numpy import array, concatenate, float32, iinfo, int8, int16, int32, int64
+from numpy import isin as numpy_isin
+from numpy import load as numpy_load
 from numpy import linspace as numpy_linspace
+from numpy import ndarray
+from numpy import round as numpy_round
+from numpy import save as numpy_save
+from numpy import unique as numpy_unique
+from numpy import zeros
+from numpy.random import Generator
 from pandas import DataFrame
+from pandas import merge as pandas_merge
 from scipy.stats import gamma as scipy_gamma
 
 from process import CLINICAL_PARAMS, TOTAL_TIMESTEPS
 from process.model import Vaccine
 
 
+def check_agents_integrity(
+    agents: DataFrame, syspop_healthcare: DataFrame, syspop_base: DataFrame
+):
+    """Check the joined agents against the synthetic population tables, e.g.,
+    every agent must be located at one place and map to one person record
+
+    Args:
+        agents (DataFrame): agents joined from diary and address
+        syspop_healthcare (DataFrame): Synthetic population healthcare data
+        syspop_base (DataFrame): Synthetic population base data
+    """
+    person_ids = agents["person_id"].unique()
+
+    proc_healthcare = syspop_healthcare[syspop_healthcare["id"].isin(person_ids)]
+    if (
+        agents.duplicated(subset=["person_id", "type", "location"]).any()
+        or proc_healthcare["id"].duplicated().any()
+    ):
+        raise Exception("Found same person (id_type) presents in multiple places ...")
+
+    if len(proc_healthcare) != len(person_ids):
+        raise Exception("Found agents without healthcare records ...")
+
+    proc_base = syspop_base[syspop_base["id"].isin(person_ids)]
+    if len(proc_base) != len(person_ids) or proc_base["id"].duplicated().any():
+        raise Exception("Found confusing agents from the dataset ...")
+
+
+def create_agents_table(
+    syspop_base: DataFrame,
+    syspop_diary: DataFrame,
+    syspop_address: DataFrame,
+    syspop_healthcare: DataFrame,
+) -> DataFrame:
+    """Create all agents (one row per person and diary location, e.g., the
+    memberships of the person) by joining the synthetic population tables
+
+    Args:
+        syspop_base (DataFrame): Synthetic population base data
+        syspop_diary (DataFrame): Synthetic population diary data
+        syspop_address (DataFrame): Synthetic population address data
+        syspop_healthcare (DataFrame): Synthetic population healthcare data
+
+    Returns:
+        DataFrame: agents with the columns of id (person), type, location,
+            mmr, age, gender and ethnicity
+    """
+    agents = syspop_diary[["id", "type", "location"]].rename(
+        columns={"id": "person_id"}
+    )
+    agents = agents[agents["location"].notna()]
+
+    # only the locations with an address are kept
+    agents = agents[agents["location"].isin(syspop_address["location"])]
+    agents = agents.reset_index(drop=True)
+
+    check_agents_integrity(agents, syspop_healthcare, syspop_base)
+
+    agents = pandas_merge(
+        agents,
+        syspop_healthcare[["id", "mmr"]].rename(columns={"id": "person_id"}),
+        on="person_id",
+        how="left",
+    )
+    agents = pandas_merge(
+        agents,
+        syspop_base[["id", "age", "gender", "ethnicity"]].rename(
+            columns={"id": "person_id"}
+        ),
+        on="person_id",
+        how="left",
+    )
+
+    return agents.rename(columns={"person_id": "id"})
+
+
 def obtain_average_imms(
-    person_agents: list, proc_vac_cfg: dict, target_ratio: float
+    agents_store, vaccine_status: ndarray, proc_vac_cfg: dict, target_ratio: float
 ) -> dict:
     """Obtain average immunisation in population
 
     Args:
-        person_agents (list): all agents to be processed
+        agents_store (AgentsStore): all agents to be processed
+        vaccine_status (ndarray): vaccine status of the agents (one member)
         proc_vac_cfg (dict): vaccination configuration
         target_ratio (float): target immunisation rate
 
     Returns:
         dict: vaccination status
     """
+    ethnicity_flag = numpy_isin(
+        agents_store.ethnicity,
+        agents_store.encode("ethnicity", proc_vac_cfg[target_ratio]["ethnicity"]),
+    )
 
-    vac_status = {"nature": [], "full": [], "partial": [], "no": []}
-    for id, proc_agent in enumerate(person_agents):
-
-        ethnicity_flag = False
-        if proc_agent.ethnicity in proc_vac_cfg[target_ratio]["ethnicity"]:
-            ethnicity_flag = True
-
-        age_flag = False
-        for proc_age in proc_vac_cfg[target_ratio]["age"]:
-            proc_age = proc_age.split("-")
-            if proc_agent.age >= int(proc_age[0]) and proc_agent.age <= int(
-                proc_age[1]
-            ):
-                age_flag = True
-                break
-
-        if (ethnicity_flag is False) or (age_flag is False):
-            continue
-
-        if proc_agent.vaccine_status.value == 0:
-            vac_status["no"].append(id)
-        elif proc_agent.vaccine_status.value == 1:
-            vac_status["partial"].append(id)
-        elif proc_agent.vaccine_status.value == 2:
-            vac_status["full"].append(id)
-        elif proc_agent.vaccine_status.value == 3:
-            vac_status["nature"].append(id)
+    age_flag = zeros(len(agents_store), dtype=bool)
+    for proc_age in proc_vac_cfg[target_ratio]["age"]:
+        proc_age = proc_age.split("-")
+        age_flag |= (agents_store.age >= int(proc_age[0])) & (
+            agents_store.age <= int(proc_age[1])
+        )
+
+    selected = ethnicity_flag & age_flag
+    vac_status = {}
+    for vac_key, vac_value in {
+        "nature": Vaccine.NATURE,
+        "full": Vaccine.FULL,
+        "partial": Vaccine.PARTIAL,
+        "no": Vaccine.NO,
+    }.items():
+        vac_status[vac_key] = (selected & (vaccine_status == vac_value)).nonzero()[0]
 
     imms = (
         len(vac_status["nature"]) + len(vac_status["full"]) + len(vac_status["partial"])
@@ -63,58 +143,74 @@ def obtain_average_imms(
 
 
 def vaccination_adjustment(
-    person_agents: list, intital_timestep: datetime, vac_measures_cfg: dict
-) -> list:
+    agents_store,
+    intital_timestep: datetime,
+    vac_measures_cfg: dict,
+    rngs: list,
+):
     """Adjust orginal vaccination coverage using the setups from configuration
 
     Args:
-        person_agents (list): all agents to be processed
+        agents_store (AgentsStore): all agents to be processed
         intital_timestep (datetime): the first timestep for the model
         vac_measures_cfg (dict): vaccination coverage configuration
+        rngs (list): random number generator (Generator) of each ensemble member
 
     Returns:
-        list: updated agents
+        AgentsStore: updated agents
     """
-    for proc_vac_cfg in vac_measures_cfg:
+    # each ensemble member (e.g., in a batch) is adjusted independently
+    for vaccine_status, imms_timestep, rng in zip(
+        agents_store.members("vaccine_status"),
+        agents_store.members("imms_timestep"),
+        rngs,
+    ):
+        for proc_vac_cfg in vac_measures_cfg:
 
-        target_ratio = list(proc_vac_cfg.keys())[0]
+            target_ratio = list(proc_vac_cfg.keys())[0]
 
-        if not proc_vac_cfg[target_ratio]["enable"]:
-            continue
+            if not proc_vac_cfg[target_ratio]["enable"]:
+                continue
 
-        population_imms = obtain_average_imms(person_agents, proc_vac_cfg, target_ratio)
-
-        if proc_vac_cfg[target_ratio]["operator"] == "fix":
-            ratio_change = target_ratio - population_imms["imms_ratio"]
-        elif proc_vac_cfg[target_ratio]["operator"] == "by":
-            ratio_change = (
-                population_imms["imms_ratio"] * target_ratio
-                - population_imms["imms_ratio"]
+            population_imms = obtain_average_imms(
+                agents_store, vaccine_status, proc_vac_cfg, target_ratio
             )
 
-        if ratio_change > 0:  # we need to improve imms
-            imms_time = proc_vac_cfg[target_ratio]["time"]
-            people_ids = random_sample(
-                population_imms["vac_status"]["no"],
-                int(population_imms["total"] * ratio_change),
-            )
-            for proc_people_id in people_ids:
-                person_agents[proc_people_id].vaccine_status = Vaccine.FULL
+            if proc_vac_cfg[target_ratio]["operator"] == "fix":
+                ratio_change = target_ratio - population_imms["imms_ratio"]
+            elif proc_vac_cfg[target_ratio]["operator"] == "by":
+                ratio_change = (
+                    population_imms["imms_ratio"] * target_ratio
+                    - population_imms["imms_ratio"]
+                )
+
+            if ratio_change > 0:  # we need to improve imms
+                imms_time = proc_vac_cfg[target_ratio]["time"]
+                people_ids = rng.choice(
+                    population_imms["vac_status"]["no"],
+                    int(population_imms["total"] * ratio_change),
+                    replace=False,
+                )
+                vaccine_status[people_ids] = Vaccine.FULL
                 if imms_time is not None:
-                    person_agents[proc_people_id].imms_timestep = get_steps(
+                    imms_timestep[people_ids] = get_steps(
                         intital_timestep, str(imms_time)
                     )
 
-        if ratio_change < 0:  # we need to remove imms
-            people_ids = random_sample(
-                population_imms["vac_status"]["full"]
-                + population_imms["vac_status"]["partial"],
-                int(population_imms["total"] * ratio_change),
-            )
-            for proc_people_id in people_ids:
-                person_agents[proc_people_id].vaccine_status = Vaccine.NO
+            if ratio_change < 0:  # we need to remove imms
+                people_ids = rng.choice(
+                    concatenate(
+                        [
+                            population_imms["vac_status"]["full"],
+                            population_imms["vac_status"]["partial"],
+                        ]
+                    ),
+                    int(population_imms["total"] * -ratio_change),
+                    replace=False,
+                )
+                vaccine_status[people_ids] = Vaccine.NO
 
-    return person_agents
+    return agents_store
 
 
 def get_steps(intital_timestep: datetime, target_time: list) -> dict or int:
@@ -144,62 +240,53 @@ def get_steps(intital_timestep: datetime, target_time: list) -> dict or int:
     return {"start": timestep_start, "end": timestep_end}
 
 
-def create_newly_increased_case(all_cases: DataFrame, state_list: list) -> DataFrame:
+def create_newly_increased_case(
+    state: ndarray, step: int, state_list: list, entered: ndarray
+) -> dict:
     """MESA output will give total infected cases at each time step,
     however, the ESR data only gives the newly reported cases for each week.
-    Here we extract the newly infected cases (e.g., target_status == 1)from MESA output
+    Here we extract the agents newly entering each state at one step (e.g.,
+    State_new_{state}): an agent is only new in a state at the first step it
+    enters the state, and nothing is new from TOTAL_TIMESTEPS on. The steps
+    are processed in one pass as they are simulated, with the entered flags
+    updated in place
 
     Args:
-        all_cases (DataFrame): _description_
-        target_status (int, optional): _description_. Defaults to 1.
+        state (ndarray): agents state at the step
+        step (int): current step
+        state_list (list): states to be extracted
+        entered (ndarray): if each agent has entered each state (state x agent)
+
+    Returns:
+        dict: agents (bool) newly entering each state
     """
-    all_cases = all_cases.reset_index()
-    if 0 in state_list:
-        state_list.remove(0)
-
-    for target_state in state_list:
-        all_cases[f"State_new_{target_state}"] = 0
-
-    for target_state in state_list:
-        newly_infected_ids = []
-        for ts in range(TOTAL_TIMESTEPS):
-            # Filter the DataFrame for the current timestep and where State transitions from 0 to 1
-            proc_state_name = f"State_new_{target_state}"
-            newly_infected = all_cases[
-                (all_cases["Step"] == ts) & (all_cases["State"] == target_state)
-            ][["Step", "AgentID", "State"]]
-            newly_infected = newly_infected[
-                ~newly_infected["AgentID"].isin(newly_infected_ids)
-            ]
-
-            newly_infected_ids.extend(list(newly_infected["AgentID"].values))
-
-            newly_infected = newly_infected.rename(columns={"State": proc_state_name})
-            all_cases.loc[newly_infected.index, proc_state_name] = newly_infected[
-                proc_state_name
-            ]
-    for target_state in state_list:
-        all_cases[f"State_new_{target_state}"][
-            all_cases[f"State_new_{target_state}"] != 0
-        ] = 1
-
-    return all_cases
-
-
-def calculate_disease_days(days: int, buffer: float):
+    newly_entered = {}
+    for state_i, target_state in enumerate(state_list):
+        proc_entered = state == target_state
+        if step < TOTAL_TIMESTEPS:
+            proc_entered &= ~entered[state_i]
+            entered[state_i] |= proc_entered
+        else:
+            proc_entered[:] = False
+        newly_entered[target_state] = proc_entered
+    return newly_entered
+
+
+def calculate_disease_days(days: int, buffer: float or ndarray, rng: Generator):
     """Create the disease days buffer
 
     Args:
         days (int): _description_
-        buffer (float): _description_
+        buffer (float or ndarray): buffer for one agent, or all agents
+        rng (Generator): random number generator
     """
     if isinstance(days, dict):
         return {
-            "start": round(days["start"] * (1 - buffer)),
-            "end": round(days["end"] * (1 + buffer)),
+            "start": numpy_round(days["start"] * (1 - buffer)),
+            "end": numpy_round(days["end"] * (1 + buffer)),
         }
     else:
-        return random_uniform(days * (1 - buffer), days * (1 + buffer))
+        return rng.uniform(days * (1 - buffer), days * (1 + buffer))
 
 
 def cal_reproduction_weight(
@@ -278,3 +365,94 @@ def cal_infectiousness_profile(
         infectiousness_profile[int(proc_t)] = y[i]
 
     return infectiousness_profile
+
+
+def get_code_dtype(total_codes: int):
+    """Obtain the smallest integer dtype holding all codes, e.g., the codes
+    of a categorical column or the profile index
+
+    Args:
+        total_codes (int): number of codes
+
+    Returns:
+        dtype: int8, int16, int32 or int64
+    """
+    for dtype in [int8, int16, int32]:
+        if total_codes <= iinfo(dtype).max + 1:
+            return dtype
+    return int64
+
+
+def create_infectiousness_profile_table(
+    start_t: ndarray, end_t: ndarray, alpha: float = 9.0, beta: float = 0.5
+) -> tuple:
+    """Create the infectiousness profiles shared by all agents, one profile
+    for each distinct (start_t, end_t) window
+
+    Args:
+        start_t (ndarray): start of the infectiousness window for each agent
+        end_t (ndarray): end of the infectiousness window for each agent
+        alpha (float, optional): Gamma shape. Defaults to 9.0.
+        beta (float, optional): Gamma rate. Defaults to 0.5.
+
+    Returns:
+        tuple: the profile table (profile x delta_t, zero outside the window)
+            and the profile index for each agent
+    """
+    windows, profile_index = numpy_unique(
+        array([start_t, end_t]).T.astype(int64), axis=0, return_inverse=True
+    )
+    profile_table = zeros((len(windows), windows[:, 1].max() + 1), dtype=float32)
+    for i, (proc_start, proc_end) in enumerate(windows):
+        proc_profile = cal_infectiousness_profile(
+            start_t=proc_start, end_t=proc_end, alpha=alpha, beta=beta
+        )
+        profile_table[i, list(proc_profile.keys())] = list(proc_profile.values())
+
+    return profile_table, profile_index.ravel().astype(get_code_dtype(len(windows)))
+
+
+def save_columns(columns: dict, columns_dir: str):
+    """Save columns (e.g., the agent arrays) as npy files, so they can be
+    memory-mapped when loading
+
+    Args:
+        columns (dict): column name and the array
+        columns_dir (str): directory to store the columns
+    """
+    makedirs(columns_dir, exist_ok=True)
+    for column_name, column_values in columns.items():
+        if column_values.dtype == object:
+            column_values = column_values.astype(str)
+        numpy_save(join(columns_dir, f"{column_name}.npy"), column_values)
+
+
+def load_columns(
+    columns_dir: str,
+    mmap_mode: str or None = "r",
+    mutable_columns: list or None = None,
+) -> dict:
+    """Load the columns saved by save_columns
+
+    Args:
+        columns_dir (str): directory storing the columns
+        mmap_mode (str or None, optional): memory-map mode for the columns,
+            e.g., "r" (read only) or None (read into memory). Defaults to "r".
+        mutable_columns (list or None, optional): columns to be updated by
+            the model, which are mapped as copy-on-write (e.g., "c"). Defaults
+            to None (no mutable columns).
+
+    Returns:
+        dict: column name and the array
+    """
+    if mutable_columns is None:
+        mutable_columns = []
+
+    columns = {}
+    for column_path in sorted(glob(join(columns_dir, "*.npy"))):
+        column_name = basename(column_path)[: -len(".npy")]
+        proc_mmap_mode = mmap_mode
+        if mmap_mode is not None and column_name in mutable_columns:
+            proc_mmap_mode = "c"
+        columns[column_name] = numpy_load(column_path, mmap_mode=proc_mmap_mode)
+    return columns
@@ -1,23 +1,24 @@
 from datetime import datetime
 from logging import getLogger
-from os.path import exists
-from random import randint as random_randint
-from random import sample as random_sample
-
-from dill import dump as dill_dump
-from mesa import Model
-from mesa.datacollection import DataCollector
-from mesa.space import ContinuousSpace
-from mesa.time import RandomActivation
-from numpy import int8
+from json import dump as json_dump
+from json import load as json_load
+from os import getpid, remove, rename, replace, symlink
+from os.path import basename, dirname, exists, islink, join, lexists, realpath
+from shutil import rmtree
+from time import time_ns
+
+from numpy.random import SeedSequence
 from pandas import DataFrame
-from pandas import to_timedelta as pandas_to_timedelta
 
 from process.model import State, Vaccine
-from process.model.disease import Agents
+from process.model.disease import NO_TIMESTEP, AgentsStore
+from process.model.engine import transmission_step
+from process.model.location import LocationIndex
+from process.model.scheduler import ActiveSetScheduler
+from process.model.streams import RandomStreams
 from process.model.utils import (
     cal_reproduction_weight,
-    create_newly_increased_case,
+    create_agents_table,
     get_steps,
     vaccination_adjustment,
 )
@@ -25,107 +26,102 @@ from process.model.utils import (
 logger = getLogger()
 
 
-class Epimodel_esr(Model):
-    def __init__(self, model_data: DataFrame):
+class Epimodel_esr:
+    # version of the model snapshot layout written by Epimodel_esr.save
+    SNAPSHOT_VERSION = 3
+
+    def __init__(self, model_data: DataFrame, seed: int or None = None):
         syspop_base = model_data["syspop_base"]
         syspop_diary = model_data["syspop_diary"]
         syspop_address = model_data["syspop_address"]
         syspop_healthcare = model_data["syspop_healthcare"]
 
-        self.grid = ContinuousSpace(
-            x_max=syspop_address.latitude.max() + 0.1,
-            y_max=syspop_address.longitude.max() + 0.1,
-            torus=False,
-            x_min=syspop_address.latitude.min() - 0.1,
-            y_min=syspop_address.longitude.min() - 0.1,
+        agents = create_agents_table(
+            syspop_base, syspop_diary, syspop_address, syspop_healthcare
         )
-        self.schedule = RandomActivation(self)
-
-        unique_ids = syspop_diary.id.unique()
-
-        total_ids = len(unique_ids)
 
-        for i, person_id in enumerate(unique_ids):
+        self.random = RandomStreams(seed)
 
-            proc_diary_locations = list(
-                syspop_diary[syspop_diary.id == person_id].location.values
-            )
-
-            for proc_diary_location in proc_diary_locations:
-
-                if proc_diary_location is None:
-                    continue
-
-                proc_address = syspop_address[
-                    syspop_address.location == proc_diary_location
-                ].drop_duplicates()
-
-                if len(proc_address) == 0:
-                    continue
-
-                if i % 500 == 0.0:
-                    logger.info(
-                        f"Creating agents: {round(i/float(total_ids) * 100.0, 3)} %"
-                    )
-
-                proc_lat = proc_address.latitude.values
-                proc_lon = proc_address.longitude.values
-                proc_imms = syspop_healthcare[
-                    syspop_healthcare.id == int(person_id.split("_")[0])
-                ]["mmr"].values
-                proc_type = syspop_diary[
-                    (syspop_diary.id == person_id)
-                    & (syspop_diary.location == proc_diary_location)
-                ].type.values
-
-                if (
-                    len(proc_lat) > 1
-                    or len(proc_lon) > 1
-                    or len(proc_imms) > 1
-                    or len(proc_type) > 1
-                ):
-                    raise Exception(
-                        "Found same person (id_type) presents in multiple places ..."
-                    )
-
-                person_attr = syspop_base[
-                    syspop_base.id == int(person_id.split("_")[0])
-                ]
-                if len(person_attr) != 1:
-                    raise Exception("Found confusing agents from the dataset ...")
-
-                person_attr = {
-                    "age": person_attr.age.values[0],
-                    "gender": person_attr.gender.values[0],
-                    "ethnicity": person_attr.ethnicity.values[0],
-                }
-
-                proc_person = Agents(
-                    person_id,
-                    person_attr,
-                    self,
-                    (
-                        proc_lat[0],
-                        proc_lon[0],
-                    ),
-                    proc_type[0],
-                    proc_imms[0],
-                )
+        self.agents_store = AgentsStore(
+            agents, rng=self.random.generator("disease_days")
+        )
 
-                self.schedule.add(proc_person)
-                self.grid.place_agent(proc_person, proc_person.pos)
+        self.location_index = LocationIndex(
+            self.agents_store.location,
+            len(self.agents_store.location_names),
+            membership_agent=self.agents_store.membership_agent,
+        )
 
         self.reproduction_weight = cal_reproduction_weight()
 
-        self.datacollector = DataCollector(agent_reporters={"State": "state"})
+        self.setup_run()
+
+    @classmethod
+    def from_columns(
+        cls,
+        agents_store: AgentsStore,
+        location_index: LocationIndex,
+        reproduction_weight: dict,
+    ):
+        """Create the model from an existing population structure, e.g.,
+        a loaded snapshot or the arrays in shared memory
+
+        Args:
+            agents_store (AgentsStore): agents store
+            location_index (LocationIndex): location index
+            reproduction_weight (dict): reproduction weight
+
+        Returns:
+            Epimodel_esr: model
+        """
+        model = cls.__new__(cls)
+        model.agents_store = agents_store
+        model.location_index = location_index
+        model.reproduction_weight = reproduction_weight
+        model.random = RandomStreams()
+        model.setup_run()
+        return model
+
+    def setup_run(self):
+        """Set up the runtime (e.g., not saved) part of the model, the model
+        outputs are written by OutputSink
+        """
+        self.schedule = ActiveSetScheduler()
+
+        self.steps = 0
 
         self.stay_at_home_if_symptom = None
 
-    def measures(self, intital_timestep: datetime, vac_cfg: dict):
-        person_agents = [
-            agent for agent in self.schedule.agents if isinstance(agent, Agents)
-        ]
+    def seed(self, seed: SeedSequence or int or list or None):
+        """Set the random number streams, e.g., each ensemble member is
+        seeded with its own child of one SeedSequence, so the results do not
+        depend on how the members are distributed over workers (or batches)
+
+        Args:
+            seed (SeedSequence or int or list or None): seed, or the seed of
+                each ensemble member in a batched run
+        """
+        self.random = RandomStreams(seed)
+
+    def snapshot(self):
+        """Keep the mutable agent columns as the baseline for Epimodel_esr.reset,
+        the immutable population structure is shared and never copied
+        """
+        self.baseline = self.agents_store.snapshot()
+
+    def reset(self, ens_number: int or None = None):
+        """Reset the model to the baseline from Epimodel_esr.snapshot, e.g.,
+        before running the next ensemble member
+
+        Args:
+            ens_number (int or None, optional): Number of ensemble members
+                to run together in one batch, None for a single run.
+                Defaults to None.
+        """
+        self.agents_store.restore(self.baseline, ens_number=ens_number)
+        self.setup_run()
 
+    def measures(self, intital_timestep: datetime, vac_cfg: dict):
         # --------------------------------
         # Stay at home if symptom
         # --------------------------------
@@ -134,7 +130,15 @@ class Epimodel_esr(Model):
         # --------------------------------
         # Vaccination adjustment
         # --------------------------------
-        vaccination_adjustment(person_agents, intital_timestep, vac_cfg["vaccine"])
+        vaccination_adjustment(
+            self.agents_store,
+            intital_timestep,
+            vac_cfg["vaccine"],
+            [
+                self.random.generator("vaccination", member_i)
+                for member_i in range(len(self.agents_store.members("state")))
+            ],
+        )
 
     def initial_infection(
         self,
@@ -142,58 +146,124 @@ class Epimodel_esr(Model):
         intital_timestep: datetime,
         cleanup_agents: bool = False,
     ):
-        person_agents = [
-            agent for agent in self.schedule.agents if isinstance(agent, Agents)
-        ]
+        agents_store = self.agents_store
 
         if cleanup_agents:
-            for agent in person_agents:
-                agent.state = State.SUSCEPTIBLE
-                agent.infection_time = None
-                agent.imms_timestep = None
-
-        for proc_infection in initial_infection:
-
-            initial_n = list(proc_infection.keys())[0]
-            proc_sampled_agents = random_sample(person_agents, initial_n)
-            proc_infection_time = proc_infection[initial_n]
+            agents_store.state[:] = State.SUSCEPTIBLE
+            agents_store.infection_time[:] = NO_TIMESTEP
+            agents_store.imms_timestep[:] = NO_TIMESTEP
+
+        # each ensemble member (e.g., in a batch) is seeded independently
+        for member_i, (state, infection_time) in enumerate(
+            zip(agents_store.members("state"), agents_store.members("infection_time"))
+        ):
+            rng = self.random.generator("initial_infection", member_i)
+            for proc_infection in initial_infection:
+
+                initial_n = list(proc_infection.keys())[0]
+                proc_sampled_agents = rng.choice(
+                    len(agents_store), initial_n, replace=False
+                )
+                proc_infection_time = proc_infection[initial_n]
 
-            for agent in proc_sampled_agents:
-                agent.state = State.SEED_INFECTION
                 proc_ts = get_steps(intital_timestep, proc_infection_time)
-                agent.infection_time = random_randint(proc_ts["start"], proc_ts["end"])
-            self.initial_infected = proc_sampled_agents
+                state[proc_sampled_agents] = State.SEED_INFECTION
+                infection_time[proc_sampled_agents] = rng.integers(
+                    proc_ts["start"], proc_ts["end"] + 1, initial_n
+                )
+                self.initial_infected = proc_sampled_agents
+
+        self.schedule.build(agents_store)
 
     def step(self, timestep):
         self.timestep = timestep
-        # self.datacollector.collect(self)
-        self.schedule.step()
-        self.datacollector.collect(self)
+        transmission_step(self, timestep)
+        self.steps += 1
 
     def save(self, model_path: str):
-        with open(model_path, "wb") as fid:
-            dill_dump(self, fid)
-
-    def postprocessing(self, intital_timestep):
-        all_agents = self.datacollector.get_agent_vars_dataframe()
-        decoded_output = create_newly_increased_case(
-            all_agents,
-            list(all_agents["State"].unique()),
-        )
-        if intital_timestep is not None:
-            # decoded_output["Step"] = pandas_to_datetime(
-            #    intital_timestep, format="%Y%m%d"
-            # ) + pandas_to_timedelta(decoded_output["Step"], unit="D")
-            decoded_output["Step"] = intital_timestep + pandas_to_timedelta(
-                decoded_output["Step"], unit="D"
+        """Save the model as a snapshot directory, e.g.,
+            - agents/*.npy: the agent columns (including the profile table)
+            - location_index/*.npy: the location index
+            - metadata.json: e.g., the reproduction weight
+        Each save writes a new versioned directory next to model_path, and
+        model_path is a symlink which is swapped to the new version with an
+        atomic replace, so jobs loading the model always find a complete
+        snapshot. The version replaced by this save is kept (a job may have
+        just resolved it), and the one before it is removed
+
+        Args:
+            model_path (str): snapshot path (a symlink to the current version)
+        """
+        version_path = f"{model_path}.{time_ns()}.{getpid()}"
+        link_path = f"{model_path}.{getpid()}.link"
+
+        previous_version = basename(realpath(model_path)) if islink(model_path) else None
+
+        self.agents_store.save(join(version_path, "agents"))
+        self.location_index.save(join(version_path, "location_index"))
+        with open(join(version_path, "metadata.json"), "w") as fid:
+            json_dump(
+                {
+                    "version": self.SNAPSHOT_VERSION,
+                    "total_agents": len(self.agents_store),
+                    "reproduction_weight": self.reproduction_weight,
+                    "previous_version": previous_version,
+                },
+                fid,
             )
 
-        all_states = list(all_agents["State"].unique())
-        all_states.remove(0)
-        for proc_state in all_states:
-            decoded_output[f"State_new_{proc_state}"] = decoded_output[
-                f"State_new_{proc_state}"
-            ].astype(int8)
-        decoded_output["State"] = decoded_output["State"].astype(int8)
+        if lexists(link_path):
+            remove(link_path)
+        symlink(basename(version_path), link_path)
+
+        if exists(model_path) and not islink(model_path):
+            # a snapshot from before the versioned layout: there is a short
+            # window (only once) where model_path does not exist
+            legacy_model_path = f"{model_path}.{getpid()}.old"
+            rename(model_path, legacy_model_path)
+            replace(link_path, model_path)
+            rmtree(legacy_model_path, ignore_errors=True)
+        else:
+            replace(link_path, model_path)
+
+        if previous_version is not None:
+            previous_path = join(dirname(model_path), previous_version)
+            try:
+                with open(join(previous_path, "metadata.json"), "r") as fid:
+                    outdated_version = json_load(fid).get("previous_version")
+            except (FileNotFoundError, ValueError):
+                outdated_version = None
+            if outdated_version is not None:
+                rmtree(join(dirname(model_path), outdated_version), ignore_errors=True)
+
+    @classmethod
+    def load(cls, model_path: str, mmap_mode: str or None = "r"):
+        """Load the model snapshot written by Epimodel_esr.save. The
+        immutable columns are memory-mapped read only (so they are shared
+        through the page cache), while the mutable columns are mapped as
+        copy-on-write
+
+        Args:
+            model_path (str): snapshot path (written by Epimodel_esr.save)
+            mmap_mode (str or None, optional): memory-map mode, None to read
+                everything into memory. Defaults to "r".
+
+        Returns:
+            Epimodel_esr: model
+        """
+        # resolve the snapshot symlink once, so all the files are read from
+        # the same version even if the model is saved again meanwhile
+        model_path = realpath(model_path)
+        with open(join(model_path, "metadata.json"), "r") as fid:
+            metadata = json_load(fid)
+
+        if metadata["version"] != cls.SNAPSHOT_VERSION:
+            raise Exception(
+                f"Model snapshot version {metadata['version']} is not supported ..."
+            )
 
-        self.output = decoded_output
+        return cls.from_columns(
+            AgentsStore.load(join(model_path, "agents"), mmap_mode=mmap_mode),
+            LocationIndex.load(join(model_path, "location_index"), mmap_mode=mmap_mode),
+            metadata["reproduction_weight"],
+        )
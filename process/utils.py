@@ -1,14 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from logging import INFO, Formatter, StreamHandler, basicConfig, getLogger
 from os import makedirs
-from os.path import exists, join
+from os.path import abspath, exists, join
 from pickle import dump as pickle_dump
 from pickle import load as pickle_load
-from random import uniform as random_uniform
 
-from dill import load as dill_load
 from numpy import round as numpy_round
-from pandas import DataFrame
+from numpy import where as numpy_where
+from pandas import DataFrame, MultiIndex
 from pandas import concat as pandas_concat
 from pandas import date_range
 from pandas import isna as pandas_isna
@@ -16,9 +16,36 @@ from pandas import merge as pandas_merge
 from pandas import read_parquet
 from pandas import read_parquet as pandas_read_parquet
 from pandas import to_datetime, to_numeric
+from pandas import to_timedelta as pandas_to_timedelta
+from pyarrow import array as pyarrow_array
+from pyarrow.dataset import Expression
+from pyarrow.dataset import dataset as pyarrow_dataset
+from pyarrow.dataset import field as pyarrow_field
+from pyarrow.types import is_dictionary
+from pyarrow.parquet import read_metadata, read_schema
+from pyarrow.parquet import read_table as parquet_read_table
 from yaml import safe_load as yaml_safe_load
 
-from process import DIARY_TYPES, SA2_DATA_PATH, SAVED_MODEL_PATH, SAMPLE_ALL_HHD_FLAG
+from process import (
+    CACHE_DIR,
+    DIARY_TYPES,
+    SA2_DATA_PATH,
+    SAMPLE_ALL_HHD_FLAG,
+    SAVED_MODEL_PATH,
+    SYSPOP_CACHE_SIZE,
+)
+from process.cache import (
+    get_cache_path,
+    get_file_key,
+    obtain_file_hash,
+    read_cache,
+    read_table_cache,
+    write_cache,
+    write_table_cache,
+)
+from process.dataset import get_agents_path, open_dataset
+from process.model.sink import OUTPUT_TIMESTEP_KEY
+from process.model.wrapper import Epimodel_esr
 
 logger = getLogger()
 
@@ -53,17 +80,25 @@ def weekly2daily_data(weekly_data: DataFrame, target_var: str = "Cases") -> Data
     # Resample to daily
     daily_data = weekly_data.resample("D").ffill()
 
-    # Distribute weekly values evenly across days
-    for week, group in daily_data.groupby(daily_data.index.strftime("%U")):
-
-        weekly_value = weekly_data.loc[
-            weekly_data.index.strftime("%U") == week, target_var
-        ].iloc[0]
-        num_days = len(group)
-        if not pandas_isna(weekly_value):
-            daily_data.loc[daily_data.index.strftime("%U") == week, target_var] = (
-                numpy_round(weekly_value / num_days, 1)
-            )
+    # Distribute weekly values evenly across days, the weeks start on Sunday
+    # (e.g., %U), and each week is identified by its first day
+    def _week_start(dates):
+        return dates - pandas_to_timedelta((dates.dayofweek + 1) % 7, unit="D")
+
+    daily_weeks = _week_start(daily_data.index)
+    weekly_values = (
+        weekly_data[target_var]
+        .groupby(_week_start(weekly_data.index))
+        .first()
+        .reindex(daily_weeks)
+        .to_numpy(dtype=float)
+    )
+    num_days = daily_data[target_var].groupby(daily_weeks).transform("size").to_numpy()
+    daily_data[target_var] = numpy_where(
+        pandas_isna(weekly_values),
+        daily_data[target_var],
+        numpy_round(weekly_values / num_days, 1),
+    )
     return daily_data
 
 
@@ -72,7 +107,11 @@ def daily2weekly_data(data_to_process: DataFrame):
 
 
 def read_obs(
-    obs_path: str, DHB_list: list, resample_flag: bool = True, ref_year: int = 2019
+    obs_path: str,
+    DHB_list: list,
+    resample_flag: bool = True,
+    ref_year: int = 2019,
+    cache_dir: str or None = CACHE_DIR,
 ):
     """Read observation data
 
@@ -80,10 +119,25 @@ def read_obs(
         obs_path (str): _description_
         DHB_list (list): _description_
         resample_flag (bool, optional): _description_. Defaults to True.
+        cache_dir (str or None, optional): Cache directory, the observations
+            are read again only if obs_path is changed, None to not use the
+            cache. Defaults to CACHE_DIR.
     """
-
-    def _week_to_date(year, week):
-        return to_datetime(f"{year} {week} 1", format="%Y %U %w")
+    if cache_dir is not None:
+        cache_path = get_cache_path(
+            cache_dir,
+            "obs",
+            {
+                "obs_path": abspath(obs_path),
+                "DHB_list": list(DHB_list),
+                "resample_flag": resample_flag,
+                "ref_year": ref_year,
+            },
+        )
+        file_key = get_file_key(obs_path)
+        cache = read_cache(cache_path)
+        if cache is not None and cache["file_key"] == file_key:
+            return cache["obs"]
 
     obs = pandas_read_parquet(obs_path)
     """
@@ -95,8 +149,9 @@ def read_obs(
     """
     obs = obs[obs["Region"].isin(DHB_list)]
     obs = obs.melt(id_vars=["Region"], var_name="Week", value_name="Cases")
-    obs["Date"] = obs["Week"].apply(
-        lambda x: _week_to_date(ref_year, int(x.split("_")[1]))
+    obs["Date"] = to_datetime(
+        f"{ref_year} " + obs["Week"].str.split("_").str[1] + " 1",
+        format="%Y %U %w",
     )
     obs["Cases"] = to_numeric(obs["Cases"], errors="coerce")
     obs.set_index("Date", inplace=True)
@@ -111,17 +166,286 @@ def read_obs(
         obs = obs.resample("W").sum()
         obs_daily = weekly2daily_data(obs)
 
-    return {"weekly": obs, "daily": obs_daily}
+    obs = {"weekly": obs, "daily": obs_daily}
+    if cache_dir is not None:
+        write_cache(cache_path, {"file_key": file_key, "obs": obs})
+
+    return obs
 
 
 def open_saved_model(model_path: str):
 
-    with open(model_path, "rb") as f:
-        model = dill_load(f)
+    model = Epimodel_esr.load(model_path)
 
     return model
 
 
+def read_output_timestep(output_path: str) -> datetime or None:
+    """Read the initial timestep kept in the metadata of a model output
+
+    Args:
+        output_path (str): Model output path
+
+    Returns:
+        datetime or None: The initial timestep, None if the Step
+            is stored as dates
+    """
+    metadata = read_schema(output_path).metadata
+    if metadata is None or OUTPUT_TIMESTEP_KEY not in metadata:
+        return None
+    return datetime.strptime(metadata[OUTPUT_TIMESTEP_KEY].decode(), "%Y%m%d")
+
+
+def read_output_steps(output_path: str) -> list:
+    """Obtain all steps of a raw model output, e.g., the integer steps are
+    taken from the statistics of the row groups without reading the Step
+
+    Args:
+        output_path (str): Model output path
+
+    Returns:
+        list: steps
+    """
+    metadata = read_metadata(output_path)
+    step_i = metadata.schema.to_arrow_schema().get_field_index("Step")
+    all_statistics = [
+        metadata.row_group(row_group_i).column(step_i).statistics
+        for row_group_i in range(metadata.num_row_groups)
+    ]
+    if read_output_timestep(output_path) is None or any(
+        statistics is None or not statistics.has_min_max
+        for statistics in all_statistics
+    ):
+        return sorted(
+            parquet_read_table(output_path, columns=["Step"])
+            .column("Step")
+            .unique()
+            .to_pylist()
+        )
+
+    if len(all_statistics) == 0:
+        return []
+
+    return list(
+        range(
+            min(statistics.min for statistics in all_statistics),
+            max(statistics.max for statistics in all_statistics) + 1,
+        )
+    )
+
+
+def read_outputs(
+    dataset_dir: str,
+    dataset_filter: Expression or None = None,
+    columns: list or None = None,
+) -> list:
+    """Read the model outputs (e.g., one for each ensemble member) from
+    a partitioned dataset, the Step is converted to dates
+
+    Args:
+        dataset_dir (str): Dataset directory
+        dataset_filter (Expression or None, optional): Partition filter,
+            e.g., field("model_id") == "1". Defaults to None.
+        columns (list or None, optional): Columns to be read. Defaults to None.
+
+    Returns:
+        list: Model outputs
+    """
+    return [
+        read_output(proc_fragment.path, columns=columns)
+        for proc_fragment in open_dataset(dataset_dir).get_fragments(
+            filter=dataset_filter
+        )
+    ]
+
+
+def read_state_counts(
+    output_path: str, state_list: list, use_summary: bool = False
+) -> DataFrame:
+    """Read the daily number of newly increased cases from a model output,
+    only the required columns and rows (e.g., State_new_{state} == 1) are read
+    and reduced immediately
+
+    Args:
+        output_path (str): Model output (or summary output) path
+        state_list (list): states to be counted
+        use_summary (bool, optional): If it is the summary output.
+            Defaults to False.
+
+    Returns:
+        DataFrame: Step, State and the number of newly increased cases (new)
+    """
+    if use_summary:
+        state_counts = (
+            parquet_read_table(
+                output_path,
+                columns=["Step", "State", "new"],
+                filters=[("State", "in", state_list)],
+            )
+            .group_by(["Step", "State"])
+            .aggregate([("new", "sum")])
+            .rename_columns(["Step", "State", "new"])
+            .to_pandas()
+        )
+    else:
+        all_state_counts = []
+        for state in state_list:
+            all_state_counts.append(
+                parquet_read_table(
+                    output_path,
+                    columns=["Step"],
+                    filters=[(f"State_new_{state}", "==", 1)],
+                )
+                .group_by("Step")
+                .aggregate([("Step", "count")])
+                .rename_columns(["Step", "new"])
+                .to_pandas()
+                .assign(State=state)
+            )
+
+        # the steps without newly increased cases are counted as zero
+        state_counts = (
+            pandas_concat(all_state_counts, ignore_index=True)
+            .set_index(["Step", "State"])["new"]
+            .reindex(
+                MultiIndex.from_product(
+                    [read_output_steps(output_path), state_list],
+                    names=["Step", "State"],
+                ),
+                fill_value=0,
+            )
+            .reset_index()
+        )
+
+    intital_timestep = read_output_timestep(output_path)
+    if intital_timestep is not None:
+        state_counts["Step"] = intital_timestep + pandas_to_timedelta(
+            state_counts["Step"], unit="D"
+        )
+    return state_counts[["Step", "State", "new"]]
+
+
+def read_all_state_counts(
+    output_paths: list, state_list: list, use_summary: bool = False, workers: int = 8
+) -> list:
+    """Read the daily number of newly increased cases from many model outputs
+    on a bounded thread pool, each output is reduced as soon as it is read
+
+    Args:
+        output_paths (list): Model output (or summary output) paths
+        state_list (list): states to be counted
+        use_summary (bool, optional): If they are the summary outputs.
+            Defaults to False.
+        workers (int, optional): Number of threads reading the outputs.
+            Defaults to 8.
+
+    Returns:
+        list: Step, State and new for each output, e.g., in the layout of
+            the summary outputs
+    """
+    total_outputs = len(output_paths)
+    all_state_counts = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, state_counts in enumerate(
+            executor.map(
+                lambda output_path: read_state_counts(
+                    output_path, state_list, use_summary=use_summary
+                ),
+                output_paths,
+            )
+        ):
+            logger.info(f"{i}/{total_outputs} ...")
+            all_state_counts.append(state_counts)
+    return all_state_counts
+
+
+def read_cached_state_counts(
+    output_paths: list,
+    state_list: list,
+    cache_path: str,
+    use_summary: bool = False,
+    workers: int = 8,
+) -> list:
+    """Read the daily number of newly increased cases from many model outputs,
+    the counts of each output are cached by the output path, modification
+    time and size, so only the new or changed outputs are read again
+
+    Args:
+        output_paths (list): Model output (or summary output) paths
+        state_list (list): states to be counted
+        cache_path (str): cache path
+        use_summary (bool, optional): If they are the summary outputs.
+            Defaults to False.
+        workers (int, optional): Number of threads reading the outputs.
+            Defaults to 8.
+
+    Returns:
+        list: Step, State and new for each output
+    """
+    cache_key = {"state_list": list(state_list), "use_summary": use_summary}
+    cache = read_cache(cache_path)
+    cached_outputs = {}
+    if cache is not None and cache["key"] == cache_key:
+        cached_outputs = cache["outputs"]
+
+    all_outputs = {}
+    new_output_paths = []
+    for output_path in output_paths:
+        file_key = get_file_key(output_path)
+        proc_cached = cached_outputs.get(output_path)
+        if proc_cached is not None and proc_cached["file_key"] == file_key:
+            all_outputs[output_path] = proc_cached
+        else:
+            # the key is taken before reading, so an output changed while
+            # being read is read again next time
+            all_outputs[output_path] = {"file_key": file_key}
+            new_output_paths.append(output_path)
+
+    logger.info(
+        f"{len(output_paths) - len(new_output_paths)} outputs from the cache, "
+        f"{len(new_output_paths)} outputs to be read ..."
+    )
+    for output_path, state_counts in zip(
+        new_output_paths,
+        read_all_state_counts(
+            new_output_paths, state_list, use_summary=use_summary, workers=workers
+        ),
+    ):
+        all_outputs[output_path]["state_counts"] = state_counts
+
+    if len(new_output_paths) > 0 or set(cached_outputs) != set(all_outputs):
+        write_cache(cache_path, {"key": cache_key, "outputs": all_outputs})
+
+    return [all_outputs[output_path]["state_counts"] for output_path in output_paths]
+
+
+def read_output(
+    output_path: str, columns: list or None = None, decode_agents: bool = False
+) -> DataFrame:
+    """Read a model output, the Step is converted to dates
+
+    Args:
+        output_path (str): Model output path
+        columns (list or None, optional): Columns to be read. Defaults to None.
+        decode_agents (bool, optional): If add the person_id, age, gender and
+            ethnicity of the AgentID (from the decode table next to the raw
+            outputs). Defaults to False.
+
+    Returns:
+        DataFrame: Model output
+    """
+    output = pandas_read_parquet(output_path, columns=columns)
+    intital_timestep = read_output_timestep(output_path)
+    if intital_timestep is not None and "Step" in output:
+        output["Step"] = intital_timestep + pandas_to_timedelta(
+            output["Step"], unit="D"
+        )
+    if decode_agents and "AgentID" in output:
+        agents = pandas_read_parquet(get_agents_path(output_path))
+        output = output.join(agents.set_index("AgentID"), on="AgentID")
+    return output
+
+
 def setup_logging(
     workdir: str = "/tmp",
     log_type: str = "epimodel_esr",
@@ -157,25 +481,205 @@ def get_sa2_from_dhb(dhb_list):
 
 
 def sample_syspop_diary_with_all_household(
-    syspop_diary: DataFrame, sample_p: float
+    syspop_diary: DataFrame, sample_p: float, sample_seed: int or None = None
 ) -> DataFrame:
     """Sample syspop diary but keep all households
 
     Args:
         syspop_diary (DataFrame): Syspop diary dataset
         sample_p (float): Sample percentage
+        sample_seed (int or None, optional): Sample seed. Defaults to None.
 
     Returns:
         Dataframe: Updated Syspop
     """
     type_household_rows = syspop_diary[syspop_diary["type"] == "household"]
     other_type_rows = syspop_diary[~syspop_diary["type"].isin(["household"])]
-    other_type_selected = other_type_rows.sample(frac=sample_p, replace=False)
+    other_type_selected = other_type_rows.sample(
+        frac=sample_p, replace=False, random_state=sample_seed
+    )
     selected_rows = pandas_concat([type_household_rows, other_type_selected])
     selected_rows = selected_rows.reset_index()
     return selected_rows
 
 
+def read_parquet_filtered(
+    parquet_path: str,
+    columns: list or None = None,
+    filters: dict or None = None,
+    drop_duplicates: bool = False,
+) -> DataFrame:
+    """Read the required columns and rows of a Parquet file, the filter is
+    pushed into the scan (e.g., the row groups are skipped with the
+    statistics) and the row batches are reduced (e.g., duplicates dropped)
+    as they are read
+
+    Args:
+        parquet_path (str): Parquet path
+        columns (list or None, optional): Columns to be read, None for all
+            the columns. Defaults to None.
+        filters (dict or None, optional): Values to be read for the columns,
+            e.g., {"area": selected_sa2}, None for all the rows.
+            Defaults to None.
+        drop_duplicates (bool, optional): If drop the duplicated rows.
+            Defaults to False.
+
+    Returns:
+        DataFrame: data
+    """
+    parquet_dataset = pyarrow_dataset(parquet_path, format="parquet")
+
+    # the values are converted to the column types, e.g., an empty selection,
+    # and to the value type of a dictionary-encoded (e.g., categorical) column
+    if filters is None:
+        filters = {}
+
+    parquet_filter = None
+    for column_name, column_values in filters.items():
+        column_type = parquet_dataset.schema.field(column_name).type
+        if is_dictionary(column_type):
+            column_type = column_type.value_type
+        column_filter = pyarrow_field(column_name).isin(
+            pyarrow_array(column_values, type=column_type)
+        )
+        parquet_filter = (
+            column_filter if parquet_filter is None else parquet_filter & column_filter
+        )
+
+    scanner = parquet_dataset.scanner(columns=columns, filter=parquet_filter)
+
+    all_data = []
+    for proc_batch in scanner.to_batches():
+        proc_data = proc_batch.to_pandas()
+        if drop_duplicates:
+            proc_data = proc_data.drop_duplicates()
+        all_data.append(proc_data)
+
+    if len(all_data) == 0:
+        return scanner.projected_schema.empty_table().to_pandas()
+
+    data = pandas_concat(all_data, ignore_index=True)
+    if drop_duplicates:
+        data = data.drop_duplicates(ignore_index=True)
+    return data
+
+
+def preprocess_syspop_data(
+    syspop_base_path: str,
+    syspop_diary_path: str,
+    syspop_address_path: str,
+    syspop_healthcare_path: str,
+    dhb_list: list or None = None,
+) -> dict:
+    """Preprocess the synthetic population data before the sampling, e.g.,
+    the diary types and the selected DHBs
+
+    Args:
+        syspop_base_path (str): Synthetic population base data
+        syspop_diary_path (str): Synthetic population diary data
+        syspop_address_path (str): Synthetic population address data
+        syspop_healthcare_path (str): Synthetic population healthcare data
+        dhb_list (list or None, optional): DHB list to be used. Defaults to None.
+
+    Returns:
+        dict: preprocessed data
+    """
+    # the filters and columns are pushed into the Parquet reads, so only
+    # the selected areas (and their people) are ever loaded
+    diary_filters = {"type": DIARY_TYPES}
+    if dhb_list is None:
+        syspop_base = read_parquet_filtered(syspop_base_path)
+        syspop_healthcare = read_parquet_filtered(syspop_healthcare_path)
+    else:
+        selected_sa2 = get_sa2_from_dhb(dhb_list)
+
+        syspop_base = read_parquet_filtered(
+            syspop_base_path,
+            columns=["id", "area", "age", "gender", "ethnicity"],
+            filters={"area": selected_sa2},
+        )
+        diary_filters["id"] = syspop_base["id"].unique()
+
+        syspop_healthcare = read_parquet_filtered(
+            syspop_healthcare_path,
+            columns=["id", "mmr"],
+            filters={"id": diary_filters["id"]},
+        )
+
+    syspop_diary = read_parquet_filtered(
+        syspop_diary_path,
+        columns=["id", "type", "location"],
+        filters=diary_filters,
+        drop_duplicates=True,
+    )
+
+    syspop_address = read_parquet_filtered(
+        syspop_address_path,
+        columns=["name"],
+        filters={"name": syspop_diary["location"].unique()},
+        drop_duplicates=True,
+    ).rename(columns={"name": "location"})
+
+    return {
+        "syspop_base": syspop_base,
+        "syspop_diary": syspop_diary,
+        "syspop_address": syspop_address,
+        "syspop_healthcare": syspop_healthcare,
+    }
+
+
+def read_preprocessed_syspop_data(
+    syspop_base_path: str,
+    syspop_diary_path: str,
+    syspop_address_path: str,
+    syspop_healthcare_path: str,
+    dhb_list: list or None = None,
+    cache_dir: str or None = CACHE_DIR,
+) -> dict:
+    """Read the preprocessed synthetic population data, from the cache if
+    the same inputs (by content) were preprocessed before, e.g., for another
+    model_id or experiment
+
+    Args:
+        syspop_base_path (str): Synthetic population base data
+        syspop_diary_path (str): Synthetic population diary data
+        syspop_address_path (str): Synthetic population address data
+        syspop_healthcare_path (str): Synthetic population healthcare data
+        dhb_list (list or None, optional): DHB list to be used. Defaults to None.
+        cache_dir (str or None, optional): Cache directory, None to not use
+            the cache. Defaults to CACHE_DIR.
+
+    Returns:
+        dict: preprocessed data
+    """
+    all_paths = [
+        syspop_base_path,
+        syspop_diary_path,
+        syspop_address_path,
+        syspop_healthcare_path,
+    ]
+    if cache_dir is None:
+        return preprocess_syspop_data(*all_paths, dhb_list=dhb_list)
+
+    if dhb_list is not None:
+        all_paths.append(SA2_DATA_PATH)
+    cache_key = {
+        "inputs": [obtain_file_hash(proc_path, cache_dir) for proc_path in all_paths],
+        # the same DHBs in any order are the same inputs
+        "dhb_list": None if dhb_list is None else sorted(dhb_list),
+        "diary_types": DIARY_TYPES,
+        "sample_all_hhd_flag": SAMPLE_ALL_HHD_FLAG,
+    }
+    syspop_data = read_table_cache(cache_dir, "syspop", cache_key)
+    if syspop_data is not None:
+        logger.info("Read the preprocessed input from the cache ...")
+        return syspop_data
+
+    syspop_data = preprocess_syspop_data(*all_paths[:4], dhb_list=dhb_list)
+    write_table_cache(cache_dir, "syspop", cache_key, syspop_data, SYSPOP_CACHE_SIZE)
+    return syspop_data
+
+
 def read_syspop_data(
     syspop_base_path: str,
     syspop_diary_path: str,
@@ -183,7 +687,9 @@ def read_syspop_data(
     syspop_healthcare_path: str,
     obs_path: str or None,
     dhb_list: list or None = None,
-    sample_p: float or None = 0.01
+    sample_p: float or None = 0.01,
+    sample_seed: int or None = None,
+    cache_dir: str or None = CACHE_DIR,
 ) -> DataFrame:
     """Read required input synthetic population data
 
@@ -194,41 +700,26 @@ def read_syspop_data(
         syspop_address_path (str): Synthetic population address data
         dhb_list (list): DHB list to be used
         sample_p (float): Sample percentage
-        sample_seed (int): Sample seed. Default: 10
+        sample_seed (int or None): Sample seed. Defaults to None.
+        cache_dir (str or None, optional): Cache directory of the preprocessed
+            inputs (only the sampling is repeated), None to not use the cache.
+            Defaults to CACHE_DIR.
 
     Returns:
         dict: decoded data
     """
 
     logger.info("Start processing input ... ")
-    syspop_base = pandas_read_parquet(syspop_base_path)
-    syspop_diary = pandas_read_parquet(syspop_diary_path)
-    syspop_healthcare = pandas_read_parquet(syspop_healthcare_path)
-    syspop_address = pandas_read_parquet(syspop_address_path)
-    syspop_address = syspop_address[["name", "latitude", "longitude"]]
-    syspop_address = syspop_address.rename(columns={"name": "location"})
-
-    syspop_diary = syspop_diary[syspop_diary["type"].isin(DIARY_TYPES)]
-
-    syspop_diary = (
-        syspop_diary[["id", "type", "location"]]
-        .drop_duplicates()
-        .reset_index()[["id", "type", "location"]]
+    syspop_data = read_preprocessed_syspop_data(
+        syspop_base_path,
+        syspop_diary_path,
+        syspop_address_path,
+        syspop_healthcare_path,
+        dhb_list=dhb_list,
+        cache_dir=cache_dir,
     )
-
-    if dhb_list is not None:
-        selected_sa2 = get_sa2_from_dhb(dhb_list)
-
-        syspop_base = syspop_base[syspop_base["area"].isin(selected_sa2)].reset_index()[
-            ["id", "area", "age", "gender", "ethnicity"]
-        ]
-        syspop_diary = syspop_diary[
-            syspop_diary["id"].isin(syspop_base.id)
-        ].reset_index()[["id", "type", "location"]]
-
-        syspop_healthcare = syspop_healthcare[
-            syspop_healthcare["id"].isin(syspop_base.id)
-        ].reset_index()[["id", "mmr"]]
+    syspop_diary = syspop_data["syspop_diary"]
+    syspop_address = syspop_data["syspop_address"]
 
     if sample_p is not None:
         # sample_size = int(sample_p * len(syspop_diary))
@@ -236,33 +727,31 @@ def read_syspop_data(
         # syspop_diary = syspop_diary.sample(sample_size, random_state=sample_seed)
         if SAMPLE_ALL_HHD_FLAG:
             syspop_diary = sample_syspop_diary_with_all_household(
-                syspop_diary, sample_p
+                syspop_diary, sample_p, sample_seed=sample_seed
             )
         else:
-            syspop_diary = syspop_diary.sample(int(sample_p * len(syspop_diary)))
+            syspop_diary = syspop_diary.sample(
+                int(sample_p * len(syspop_diary)), random_state=sample_seed
+            )
         logger.info(f"Selected {len(syspop_diary)} samples ...")
 
     syspop_address = syspop_address[
         syspop_address["location"].isin(syspop_diary.location)
-    ].reset_index()[["location", "latitude", "longitude"]]
-
-    syspop_diary["id_type"] = (
-        syspop_diary["id"].astype(str) + "_" + syspop_diary["type"]
-    )
+    ].reset_index()[["location"]]
 
-    syspop_diary = syspop_diary[["id_type", "type", "location"]].rename(
-        columns={"id_type": "id"}
-    )
+    # the agents are identified by the person id, and the diary locations
+    # (type and location) are the memberships of the agent in the model
+    syspop_diary = syspop_diary[["id", "type", "location"]]
 
     obs = None
     if obs_path is not None:
-        obs = read_obs(obs_path, dhb_list)
+        obs = read_obs(obs_path, dhb_list, cache_dir=cache_dir)
 
     return {
-        "syspop_base": syspop_base,
+        "syspop_base": syspop_data["syspop_base"],
         "syspop_diary": syspop_diary,
         "syspop_address": syspop_address,
-        "syspop_healthcare": syspop_healthcare,
+        "syspop_healthcare": syspop_data["syspop_healthcare"],
         "obs": obs,
     }
 
@@ -0,0 +1,329 @@
+from copy import deepcopy
+
+from numpy import (
+    add,
+    ceil,
+    clip,
+    cumsum,
+    float64,
+    floor,
+    int64,
+    load,
+    log,
+    ndarray,
+    power,
+    savez,
+    where,
+    zeros,
+)
+from pandas import Index, Series
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch (e.g., DDSketch) for each timestep. The values
+    are counted in logarithmic buckets, so a quantile is obtained within the
+    relative accuracy (e.g., 1%) from a fixed number of buckets, without
+    keeping the values. The values must be non-negative (e.g., the number of
+    cases)
+    """
+
+    def __init__(self, total_steps: int, relative_accuracy: float = 0.01):
+        """Create an empty sketch
+
+        Args:
+            total_steps (int): number of timesteps
+            relative_accuracy (float, optional): relative accuracy of the
+                quantiles. Defaults to 0.01.
+        """
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+        self.min_key = 0
+        self.zero_counts = zeros(total_steps, dtype=int64)
+        self.counts = zeros((total_steps, 0), dtype=int64)
+
+    def get_keys(self, values: ndarray) -> ndarray:
+        """Obtain the bucket of the (positive) values
+
+        Args:
+            values (ndarray): values
+
+        Returns:
+            ndarray: bucket keys
+        """
+        return ceil(log(values) / log(self.gamma)).astype(int64)
+
+    def get_values(self, keys: ndarray) -> ndarray:
+        """Obtain the representative value of the buckets
+
+        Args:
+            keys (ndarray): bucket keys
+
+        Returns:
+            ndarray: values
+        """
+        return 2.0 * power(self.gamma, keys) / (self.gamma + 1.0)
+
+    def extend_keys(self, min_key: int, max_key: int):
+        """Extend the buckets to cover the keys from min_key to max_key
+
+        Args:
+            min_key (int): minimum key
+            max_key (int): maximum key
+        """
+        total_keys = self.counts.shape[1]
+        if total_keys == 0:
+            self.min_key = min_key
+        new_min_key = min(self.min_key, min_key)
+        new_total_keys = max(self.min_key + total_keys, max_key + 1) - new_min_key
+        if new_min_key == self.min_key and new_total_keys == total_keys:
+            return
+
+        counts = zeros((len(self.zero_counts), new_total_keys), dtype=int64)
+        offset = self.min_key - new_min_key
+        counts[:, offset : offset + total_keys] = self.counts
+        self.min_key = new_min_key
+        self.counts = counts
+
+    def add(self, values: ndarray):
+        """Add one value for each timestep, e.g., an ensemble member
+
+        Args:
+            values (ndarray): values (timestep)
+        """
+        if (values < 0).any():
+            raise Exception("The values of the quantile sketch must be non-negative")
+
+        positive = values > 0
+        self.zero_counts += ~positive
+        if not positive.any():
+            return
+
+        keys = self.get_keys(values[positive])
+        self.extend_keys(keys.min(), keys.max())
+        add.at(self.counts, (positive.nonzero()[0], keys - self.min_key), 1)
+
+    def merge(self, other):
+        """Merge another sketch (of the same timesteps and accuracy)
+
+        Args:
+            other (QuantileSketch): sketch to be merged
+        """
+        if other.gamma != self.gamma:
+            raise Exception("Only the sketches of the same accuracy can be merged")
+
+        self.zero_counts += other.zero_counts
+        total_keys = other.counts.shape[1]
+        if total_keys == 0:
+            return
+        self.extend_keys(other.min_key, other.min_key + total_keys - 1)
+        offset = other.min_key - self.min_key
+        self.counts[:, offset : offset + total_keys] += other.counts
+
+    def reindex(self, positions: ndarray, total_steps: int, fill_zeros: int):
+        """Move the timesteps to new positions, e.g., when new timesteps are
+        added. The new timesteps count fill_zeros zeros
+
+        Args:
+            positions (ndarray): new position of each timestep
+            total_steps (int): new number of timesteps
+            fill_zeros (int): zeros counted for the new timesteps
+        """
+        zero_counts = zeros(total_steps, dtype=int64) + fill_zeros
+        zero_counts[positions] = self.zero_counts
+        counts = zeros((total_steps, self.counts.shape[1]), dtype=int64)
+        counts[positions] = self.counts
+        self.zero_counts = zero_counts
+        self.counts = counts
+
+    def value_at_rank(self, ranks: ndarray) -> ndarray:
+        """Obtain the value at a (0-based) rank for each timestep
+
+        Args:
+            ranks (ndarray): ranks (timestep)
+
+        Returns:
+            ndarray: values (timestep)
+        """
+        ranks = ranks.reshape(-1, 1)
+        key_i = (
+            (self.zero_counts.reshape(-1, 1) + cumsum(self.counts, axis=1)) <= ranks
+        ).sum(axis=1)
+        key_i = clip(key_i, 0, max(self.counts.shape[1] - 1, 0))
+        return where(
+            ranks[:, 0] < self.zero_counts,
+            0.0,
+            self.get_values(self.min_key + key_i),
+        )
+
+    def percentile(self, percentiles: list, total_values: int) -> ndarray:
+        """Obtain the percentiles, interpolated between the ranks as in
+        numpy.percentile
+
+        Args:
+            percentiles (list): percentiles, e.g., [50, 75, 90]
+            total_values (int): number of values for each timestep
+
+        Returns:
+            ndarray: values (percentile x timestep)
+        """
+        total_steps = len(self.zero_counts)
+        all_values = zeros((len(percentiles), total_steps), dtype=float64)
+        if total_values == 0:
+            return all_values
+
+        for i, proc_percentile in enumerate(percentiles):
+            rank = proc_percentile / 100.0 * (total_values - 1)
+            lower_values = self.value_at_rank(zeros(total_steps) + floor(rank))
+            upper_values = self.value_at_rank(zeros(total_steps) + ceil(rank))
+            all_values[i] = lower_values + (rank - floor(rank)) * (
+                upper_values - lower_values
+            )
+        return all_values
+
+
+class EnsembleStats:
+    """Streaming statistics of the ensemble members for each timestep, e.g.,
+    the running mean and variance (Welford) and the quantile sketch. The
+    members are added one at a time, and the statistics from separate jobs
+    (e.g., models or experiments) can be merged, so the whole ensemble is
+    never kept in memory. A timestep missing in a member counts as zero
+    """
+
+    def __init__(self, index: Index or None = None, relative_accuracy: float = 0.01):
+        """Create empty statistics
+
+        Args:
+            index (Index or None, optional): timesteps. Defaults to None.
+            relative_accuracy (float, optional): relative accuracy of the
+                percentiles. Defaults to 0.01.
+        """
+        self.index = Index([]) if index is None else index
+        self.total_members = 0
+        self.mean = zeros(len(self.index), dtype=float64)
+        self.m2 = zeros(len(self.index), dtype=float64)
+        self.sketch = QuantileSketch(
+            len(self.index), relative_accuracy=relative_accuracy
+        )
+
+    def align(self, index: Index):
+        """Add the new timesteps of index, e.g., of a new member
+
+        Args:
+            index (Index): timesteps
+        """
+        if index.isin(self.index).all():
+            return
+
+        new_index = index if len(self.index) == 0 else self.index.union(index)
+        positions = new_index.get_indexer(self.index)
+        for stats_name in ["mean", "m2"]:
+            stats_values = zeros(len(new_index), dtype=float64)
+            stats_values[positions] = getattr(self, stats_name)
+            setattr(self, stats_name, stats_values)
+        self.sketch.reindex(positions, len(new_index), self.total_members)
+        self.index = new_index
+
+    def update(self, member_data: Series):
+        """Add an ensemble member
+
+        Args:
+            member_data (Series): member values (e.g., the number of cases),
+                indexed by timestep
+        """
+        self.align(member_data.index)
+        values = member_data.reindex(self.index, fill_value=0).to_numpy(dtype=float64)
+
+        self.total_members += 1
+        delta = values - self.mean
+        self.mean += delta / self.total_members
+        self.m2 += delta * (values - self.mean)
+        self.sketch.add(values)
+
+    def merge(self, other):
+        """Merge the statistics of other members, e.g., from another job
+
+        Args:
+            other (EnsembleStats): statistics to be merged
+        """
+        self.align(other.index)
+        if not other.index.equals(self.index):
+            other = deepcopy(other)
+            other.align(self.index)
+
+        # the running mean and variance are combined as in Chan et al.
+        total_members = self.total_members + other.total_members
+        if total_members > 0:
+            delta = other.mean - self.mean
+            self.m2 += (
+                other.m2
+                + delta**2 * self.total_members * other.total_members / total_members
+            )
+            self.mean += delta * other.total_members / total_members
+        self.sketch.merge(other.sketch)
+        self.total_members = total_members
+
+    def variance(self, ddof: int = 1) -> ndarray:
+        """Obtain the variance of the members for each timestep
+
+        Args:
+            ddof (int, optional): delta degrees of freedom. Defaults to 1.
+
+        Returns:
+            ndarray: variance (timestep)
+        """
+        if self.total_members <= ddof:
+            return zeros(len(self.index), dtype=float64)
+        return self.m2 / (self.total_members - ddof)
+
+    def percentile(self, percentiles: list) -> ndarray:
+        """Obtain the percentiles of the members for each timestep
+
+        Args:
+            percentiles (list): percentiles, e.g., [50, 75, 90]
+
+        Returns:
+            ndarray: values (percentile x timestep)
+        """
+        return self.sketch.percentile(percentiles, self.total_members)
+
+    def save(self, stats_path: str):
+        """Save the statistics, e.g., to be merged by another job
+
+        Args:
+            stats_path (str): statistics path (.npz)
+        """
+        with open(stats_path, "wb") as fid:
+            savez(
+                fid,
+                index=self.index.to_numpy(),
+                total_members=self.total_members,
+                mean=self.mean,
+                m2=self.m2,
+                relative_accuracy=self.sketch.relative_accuracy,
+                min_key=self.sketch.min_key,
+                zero_counts=self.sketch.zero_counts,
+                counts=self.sketch.counts,
+            )
+
+    @classmethod
+    def load(cls, stats_path: str):
+        """Load the statistics saved by EnsembleStats.save
+
+        Args:
+            stats_path (str): statistics path (.npz)
+
+        Returns:
+            EnsembleStats: statistics
+        """
+        with load(stats_path) as stats_data:
+            ens_stats = cls(
+                index=Index(stats_data["index"]),
+                relative_accuracy=float(stats_data["relative_accuracy"]),
+            )
+            ens_stats.total_members = int(stats_data["total_members"])
+            ens_stats.mean = stats_data["mean"]
+            ens_stats.m2 = stats_data["m2"]
+            ens_stats.sketch.min_key = int(stats_data["min_key"])
+            ens_stats.sketch.zero_counts = stats_data["zero_counts"]
+            ens_stats.sketch.counts = stats_data["counts"]
+        return ens_stats
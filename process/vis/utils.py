@@ -1,10 +1,128 @@
 from logging import getLogger
 
-from pandas import DataFrame
+from numpy import int64, ndarray, zeros
+from pandas import DataFrame, Index
 
 logger = getLogger()
 
 
+def count_states(
+    data_to_process: DataFrame,
+    plot_increment: bool,
+    state_list: list,
+    use_summary: bool = False,
+) -> DataFrame:
+    """Count the agents for all states of one output in one grouping
+
+    Args:
+        data_to_process (DataFrame): model output (or summary output), can be
+            a dask DataFrame
+        plot_increment (bool): If count the newly increased case,
+            otherwise the prevalent case
+        state_list (list): states to be counted
+        use_summary (bool, optional): If data_to_process is the summary output.
+            Defaults to False.
+
+    Returns:
+        DataFrame: number of agents (Step x state)
+    """
+    if use_summary:
+        count_key = "new" if plot_increment else "prevalent"
+        return (
+            data_to_process[data_to_process["State"].isin(state_list)]
+            .groupby(["Step", "State"])[count_key]
+            .sum()
+            .unstack(fill_value=0)
+        )
+
+    state_flags = {
+        f"State_{state}": (
+            data_to_process[f"State_new_{state}"] == 1
+            if plot_increment
+            else data_to_process["State"] == state
+        )
+        for state in state_list
+    }
+    return (
+        data_to_process[["Step"]]
+        .assign(**state_flags)
+        .groupby("Step")
+        .sum()
+        .rename(columns={f"State_{state}": state for state in state_list})
+    )
+
+
+def obtain_state_counts(
+    data_to_process: DataFrame or list,
+    plot_increment: bool,
+    state_list: list,
+    use_dask: bool = False,
+    use_summary: bool = False,
+) -> tuple:
+    """Count the agents for all states and all outputs (e.g., ensemble members)
+    in one pass, with dask all the outputs are computed together in one graph
+
+    Args:
+        data_to_process (DataFrame or list): model outputs
+        plot_increment (bool): If count the newly increased case,
+            otherwise the prevalent case
+        state_list (list): states to be counted
+        use_dask (bool, optional): If the outputs are dask DataFrames.
+            Defaults to False.
+        use_summary (bool, optional): If the outputs are the summary outputs.
+            Defaults to False.
+
+    Returns:
+        tuple: steps and the number of agents (member x step x state)
+    """
+    if isinstance(data_to_process, DataFrame):
+        data_to_process = [data_to_process]
+
+    logger.info(f"Grouping {len(data_to_process)} outputs ...")
+    all_counts = [
+        count_states(proc_data, plot_increment, state_list, use_summary=use_summary)
+        for proc_data in data_to_process
+    ]
+    if use_dask:
+        # dask is only required when the outputs are dask DataFrames
+        from dask import compute as dask_compute
+
+        all_counts = dask_compute(*all_counts)
+
+    steps = all_counts[0].index if len(all_counts) > 0 else Index([], name="Step")
+    for proc_counts in all_counts[1:]:
+        steps = steps.union(proc_counts.index)
+
+    counts = zeros((len(all_counts), len(steps), len(state_list)), dtype=int64)
+    for member_i, proc_counts in enumerate(all_counts):
+        counts[member_i] = proc_counts.reindex(
+            index=steps, columns=state_list, fill_value=0
+        ).to_numpy()
+
+    return steps, counts
+
+
+def counts_to_grouped(steps: Index, counts: ndarray, state_list: list) -> dict:
+    """Convert the number of agents to the grouped data for plotting
+
+    Args:
+        steps (Index): steps
+        counts (ndarray): number of agents (member x step x state)
+        state_list (list): states
+
+    Returns:
+        dict: for each state, the number of agents (indexed by Step)
+            for each member
+    """
+    return {
+        state: [
+            DataFrame({state: proc_counts[:, state_i]}, index=steps.rename("Step"))
+            for proc_counts in counts
+        ]
+        for state_i, state in enumerate(state_list)
+    }
+
+
 def data_transformer(
     data_to_process: DataFrame, plot_increment: bool, state_list: list, use_dask: bool
 ):
@@ -18,43 +136,28 @@ def data_transformer(
     Returns:
         _type_: _description_
     """
-    all_grouped = {}
-
-    for state in state_list:
-        state_key = "State"
-        if plot_increment:
-            state_key = f"State_new_{state}"
-
-        if isinstance(data_to_process, DataFrame):
-            logger.info(f"Grouping ...")
-            proc_data_to_plot = (
-                data_to_process.groupby(["Step", state_key])
-                .size()
-                .unstack(fill_value=0)
-            )
-            proc_data_to_plot.columns.name = None
-            proc_data_to_plot = proc_data_to_plot[[1]]
-            proc_data_to_plot = proc_data_to_plot.rename(columns={1: state})
-            grouped = [proc_data_to_plot]
-        else:
-            grouped = []
-            total_jobs = len(data_to_process)
-            for i, proc_data_to_plot in enumerate(data_to_process):
-
-                logger.info(f"Grouping {i} / {total_jobs} ...")
-
-                proc_data_to_plot = proc_data_to_plot.groupby(
-                    ["Step", state_key]
-                ).size()
-                if use_dask:
-                    proc_data_to_plot = proc_data_to_plot.compute()
-                proc_data_to_plot = proc_data_to_plot.unstack(fill_value=0)
-
-                proc_data_to_plot.columns.name = None
-                proc_data_to_plot = proc_data_to_plot[[1]]
-                proc_data_to_plot = proc_data_to_plot.rename(columns={1: state})
-                grouped.append(proc_data_to_plot)
-
-        all_grouped[state] = grouped
-
-    return all_grouped
+    steps, counts = obtain_state_counts(
+        data_to_process, plot_increment, state_list, use_dask=use_dask
+    )
+    return counts_to_grouped(steps, counts, state_list)
+
+
+def summary_transformer(
+    summaries: list, plot_increment: bool, state_list: list
+) -> dict:
+    """Obtain the (daily) number of agents from the summary outputs
+
+    Args:
+        summaries (list): summary outputs, e.g., one for each ensemble member
+        plot_increment (bool): If use the newly increased case,
+            otherwise the prevalent case
+        state_list (list): states to be obtained
+
+    Returns:
+        dict: for each state, the number of agents (indexed by Step)
+            for each summary output
+    """
+    steps, counts = obtain_state_counts(
+        summaries, plot_increment, state_list, use_summary=True
+    )
+    return counts_to_grouped(steps, counts, state_list)
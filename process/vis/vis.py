@@ -1,4 +1,4 @@
-from os.path import join
+from os.path import dirname, join
 from pickle import dump as pickle_dump
 from random import sample as random_sample
 
@@ -21,27 +21,29 @@ from matplotlib.pyplot import (
     ylabel,
     ylim,
 )
-from mesa.agent import AgentSet as mesa_agentset
-from numpy import arange, array, linspace, percentile
+from numpy import arange, linspace
 from pandas import DataFrame
 
 from process import VIS_COLOR
-from process.model.disease import State
+from process.model.disease import AgentsStore, State
 from process.utils import create_dir, daily2weekly_data
+from process.vis.stats import EnsembleStats
 
 
 def plot_infectiousness_profile(
-    workdir: str, model_agents: mesa_agentset, sample_size: int = 100
+    workdir: str, agents_store: AgentsStore, sample_size: int = 100
 ):
-    total_agents = len(model_agents)
+    total_agents = len(agents_store)
 
     agents_ids = random_sample(list(range(total_agents)), sample_size)
 
     for proc_agent_id in agents_ids:
-        proc_infectiousness_profile = model_agents[proc_agent_id].infectiousness_profile
+        proc_infectiousness_profile = agents_store.infectiousness_profile_table[
+            agents_store.infectiousness_profile[proc_agent_id]
+        ]
         plot(
-            list(proc_infectiousness_profile.keys()),
-            list(proc_infectiousness_profile.values()),
+            arange(len(proc_infectiousness_profile)),
+            proc_infectiousness_profile,
             linestyle="-",
             color="k",
         )
@@ -72,6 +74,9 @@ def plot_data(
     outlier_percentile: int = 95,
     model_ids: None = None,
     only_group_data: bool = False,
+    stats_path: str or None = None,
+    other_stats: list or None = None,
+    max_plot_members: int or None = None,
 ):
     """Plot individual state data
 
@@ -88,25 +93,50 @@ def plot_data(
         plot_weekly_data (bool, optional): If convert daily data to weekly and plot. Defaults to True.
         plot_cfg (_type_, optional): Plot configuration. Defaults to {"linewidth": 0.5, "linestyle": "-"}.
         state_list (list, optional): Which state to plot. Defaults to [1, 2].
+        stats_path (str or None, optional): Path (.npz) to save the ensemble
+            statistics of grouped_data, e.g., to be merged by another job.
+            Defaults to None.
+        other_stats (list or None, optional): Ensemble statistics
+            (EnsembleStats) of other members (e.g., from separate jobs) merged
+            for the percentiles. Defaults to None.
+        max_plot_members (int or None, optional): Maximum number of members
+            plotted (and exported) as lines, e.g., to bound the memory for a
+            large ensemble, None for all members. The percentiles always use
+            all members. Defaults to None.
     """
-    output = {}
+    plot_members = []
     export_data = {"percentile": None, "ens": None, "time": None, "obs": None}
-    for i, proc_grouped in enumerate(grouped_data):
+    # the percentiles are obtained from the streaming statistics, so only
+    # the members plotted as lines are kept
+    ens_stats = None
+    if plot_percentile_flag or stats_path is not None:
+        ens_stats = EnsembleStats()
+    time_index = None
+    for proc_grouped in grouped_data:
 
         proc_grouped_data = proc_grouped[state]
 
         if plot_weekly_data:
             proc_grouped_data = daily2weekly_data(proc_grouped_data)
 
-        if state not in output:
-            output[state] = []
+        time_index = proc_grouped_data.index
+        if max_plot_members is None or len(plot_members) < max_plot_members:
+            plot_members.append(proc_grouped_data)
+        if ens_stats is not None:
+            ens_stats.update(proc_grouped_data)
+
+    if stats_path is not None and ens_stats.total_members > 0:
+        create_dir(dirname(stats_path))
+        ens_stats.save(stats_path)
 
-        output[state].append(proc_grouped_data)
+    if plot_percentile_flag and other_stats is not None:
+        for proc_stats in other_stats:
+            ens_stats.merge(proc_stats)
+        if time_index is None:
+            time_index = ens_stats.index
 
     data_percentiles_outlier = None
     if plot_percentile_flag:
-        output_transpose = array(list(zip(*output[state]))).transpose()
-
         percentiles = {
             50: {"color": "r", "label": "median"},
             75: {"color": "g", "label": "75th percentile"},
@@ -114,13 +144,11 @@ def plot_data(
         }
 
         # Calculate percentiles
-        data_percentiles = percentile(
-            output_transpose, list(percentiles.keys()), axis=0
-        )
+        data_percentiles = ens_stats.percentile(list(percentiles.keys()))
 
         for i, percentile_key in enumerate(percentiles):
             plot(
-                output[state][0].index,
+                ens_stats.index,
                 data_percentiles[i, :],
                 color=percentiles[percentile_key]["color"],
                 label=percentiles[percentile_key]["label"],
@@ -131,11 +159,9 @@ def plot_data(
                 export_data["percentile"][percentile_key] = data_percentiles[i, :]
 
         if remove_outlier:
-            data_percentiles_outlier = percentile(
-                output_transpose, outlier_percentile, axis=0
-            )
+            data_percentiles_outlier = ens_stats.percentile([outlier_percentile])[0]
 
-    for i, proc_grouped_data in enumerate(output[state]):
+    for i, proc_grouped_data in enumerate(plot_members):
 
         if data_percentiles_outlier is not None:
             if proc_grouped_data.sum() > data_percentiles_outlier.sum():
@@ -161,7 +187,10 @@ def plot_data(
             )
             export_data["ens"].append(proc_grouped_data.values)
 
-    ref_data = proc_grouped_data
+    if export_data["time"] is None and time_index is not None:
+        export_data["time"] = time_index.to_pydatetime().tolist()
+
+    ref_index = time_index
 
     if obs is not None:
         if plot_weekly_data:
@@ -170,15 +199,15 @@ def plot_data(
             obs_to_plot = obs["daily"]
 
         obs_to_plot = obs_to_plot[
-            (obs_to_plot.index >= proc_grouped_data.index.min())
-            & (obs_to_plot.index <= proc_grouped_data.index.max())
+            (obs_to_plot.index >= time_index.min())
+            & (obs_to_plot.index <= time_index.max())
         ]
-        min_date = min(proc_grouped_data.index.min(), obs_to_plot.index.min())
-        max_date = max(proc_grouped_data.index.max(), obs_to_plot.index.max())
+        min_date = min(time_index.min(), obs_to_plot.index.min())
+        max_date = max(time_index.max(), obs_to_plot.index.max())
         obs_to_plot = obs_to_plot.loc[
             (obs_to_plot.index >= min_date) & (obs_to_plot.index <= max_date)
         ]
-        ref_data = obs_to_plot
+        ref_index = obs_to_plot.index
         bar(obs_to_plot.index, obs_to_plot["Cases"], width=5.0, label="confirmed cases")
         export_data["obs"] = obs_to_plot["Cases"].values
 
@@ -195,10 +224,10 @@ def plot_data(
         open(join(export_data_dir, f"{filename_base}.pickle"), "wb"),
     )
 
-    downsample_factor = max(1, len(ref_data.index) // 10)
+    downsample_factor = max(1, len(ref_index) // 10)
 
     # Select every nth element from the index
-    downsampled_index = ref_data.index[::downsample_factor]
+    downsampled_index = ref_index[::downsample_factor]
 
     xtick_labels = downsampled_index.strftime(
         "%m-%d"
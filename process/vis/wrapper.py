@@ -3,7 +3,7 @@ from os.path import exists
 
 from pandas import DataFrame
 
-from process.vis.utils import data_transformer
+from process.vis.utils import data_transformer, summary_transformer
 from process.vis.vis import plot_data, plot_infectiousness_profile
 
 
@@ -26,6 +26,10 @@ def plot_wrapper(
     model_ids: None = None,
     only_group_data: bool = False,
     use_dask: bool = False,
+    use_summary: bool = False,
+    stats_path: str or None = None,
+    other_stats: dict or None = None,
+    max_plot_members: int or None = None,
 ):
     """Plot timeseries such as infection and its comparisons with obs
 
@@ -42,6 +46,17 @@ def plot_wrapper(
         plot_weekly_data (bool, optional): If convert daily data to weekly and plot. Defaults to True.
         plot_cfg (_type_, optional): Plot configuration. Defaults to {"linewidth": 0.5, "linestyle": "-"}.
         state_list (list, optional): Which state to plot. Defaults to [1, 2].
+        use_summary (bool, optional): If data_to_plot are the summary outputs.
+            Defaults to False.
+        stats_path (str or None, optional): Path prefix to save the ensemble
+            statistics of data_to_plot, e.g., {stats_path}_state2_weekly.npz,
+            to be merged by another job. Defaults to None.
+        other_stats (dict or None, optional): For each state, the ensemble
+            statistics (EnsembleStats) of other jobs merged for the
+            percentiles. Defaults to None.
+        max_plot_members (int or None, optional): Maximum number of members
+            plotted (and exported) as lines, None for all members.
+            Defaults to None.
     """
 
     if not exists(workdir):
@@ -50,7 +65,12 @@ def plot_wrapper(
     if agents is not None:
         plot_infectiousness_profile(workdir, agents)
 
-    all_grouped = data_transformer(data_to_plot, plot_increment, state_list, use_dask)
+    if use_summary:
+        all_grouped = summary_transformer(data_to_plot, plot_increment, state_list)
+    else:
+        all_grouped = data_transformer(
+            data_to_plot, plot_increment, state_list, use_dask
+        )
 
     filename_suffix = "daily"
     if plot_weekly_data:
@@ -73,4 +93,11 @@ def plot_wrapper(
             remove_outlier,
             model_ids=model_ids,
             only_group_data=only_group_data,
+            stats_path=(
+                None
+                if stats_path is None
+                else f"{stats_path}_state{proc_state}_{filename_suffix}.npz"
+            ),
+            other_stats=None if other_stats is None else other_stats.get(proc_state),
+            max_plot_members=max_plot_members,
         )
@@ -1,21 +1,39 @@
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from glob import glob
 from logging import getLogger
 from os import makedirs
 from os.path import exists, join
 
-from pandas import read_parquet
-from pandas import read_parquet as pandas_read_parquet
+from numpy.random import SeedSequence
+from pyarrow.dataset import field as pyarrow_field
 
-from process import ENS_NUMBER, SAVED_MODEL_PATH, TOTAL_TIMESTEPS
+from process import (
+    CACHE_DIR,
+    ENS_NUMBER,
+    RAW_DATASET,
+    SAVED_MODEL_PATH,
+    SUMMARY_DATASET,
+    TOTAL_TIMESTEPS,
+)
+from process.dataset import (
+    create_dataset_dir,
+    get_dataset_path,
+    open_dataset,
+    update_manifest,
+    write_agents_table,
+    write_file_manifest,
+)
+from process.model.parallel import SharedModel, attach_model
+from process.model.sink import OutputSink
 from process.model.wrapper import Epimodel_esr
 from process.utils import (
     create_dir,
     get_model_path,
     open_saved_model,
     read_cfg,
+    read_all_state_counts,
     read_obs,
+    read_outputs,
     read_syspop_data,
 )
 from process.vis.wrapper import plot_wrapper
@@ -45,12 +63,147 @@ def create_model_wrapper(workdir: str, cfg_path: str, model_id: str):
         cfg["data_path"]["syspop_healthcare"],
         cfg["data_path"]["obs"],
         sample_p=cfg["sample_ratio"],
-        dhb_list=cfg["dhb_list"]
+        dhb_list=cfg["dhb_list"],
+        sample_seed=cfg.get("seed"),
+        cache_dir=cfg.get("cache_dir", CACHE_DIR),
     )
-    model = Epimodel_esr(data)
+    model = Epimodel_esr(data, seed=cfg.get("seed"))
     model.save(saved_model_path)
 
 
+# the model attached to the shared memory in each worker process
+ENS_WORKER = {}
+
+
+def run_ens_member(
+    model: Epimodel_esr,
+    cfg: dict,
+    intital_timestep: datetime,
+    ens_batch: list,
+    seed: SeedSequence or list,
+    output_dir: str,
+    model_id: str,
+    batched_ens: bool = False,
+):
+    """Run ensemble members and write their outputs
+
+    Args:
+        model (Epimodel_esr): model with the baseline from Epimodel_esr.snapshot
+        cfg (dict): run_model configuration
+        intital_timestep (datetime): the first timestep for the model
+        ens_batch (list): ensemble members, more than one member requires batched_ens
+        seed (SeedSequence or list): seed for the member, or the seed of
+            each member (batched_ens)
+        output_dir (str): output directory, e.g., the root of the datasets
+        model_id (str): Model ID
+        batched_ens (bool, optional): If all members run together in one batch.
+            Defaults to False.
+    """
+    logger.info(f"Initialize the EpiModel_ESR {ens_batch}...")
+
+    logger.info(f"Resetting the model ...")
+    model.reset(ens_number=len(ens_batch) if batched_ens else None)
+    model.seed(seed)
+
+    logger.info(f"Create initial infector ...")
+    model.initial_infection(
+        cfg["seed_infection"], intital_timestep, cleanup_agents=True
+    )
+
+    logger.info(f"Update measures ...")
+    model.measures(intital_timestep, cfg["measures"])
+
+    # the outputs are written while the model runs
+    # the summary outputs are always written, the raw (per agent) outputs
+    # are optional
+    dataset_dirs = [join(output_dir, SUMMARY_DATASET)]
+    if cfg.get("raw_output", True):
+        dataset_dirs.append(join(output_dir, RAW_DATASET))
+
+    partitions = [get_output_partition(cfg, model_id, ens_i) for ens_i in ens_batch]
+    for dataset_dir in dataset_dirs:
+        for partition in partitions:
+            create_dataset_dir(dataset_dir, partition)
+
+    summary_groups = cfg.get("summary_groups", [])
+    output_sink = OutputSink(
+        len(model.agents_store),
+        intital_timestep,
+        output_paths=(
+            [
+                get_dataset_path(join(output_dir, RAW_DATASET), partition)
+                for partition in partitions
+            ]
+            if cfg.get("raw_output", True)
+            else None
+        ),
+        summary_paths=[
+            get_dataset_path(join(output_dir, SUMMARY_DATASET), partition)
+            for partition in partitions
+        ],
+        summary_groups=model.agents_store.summary_groups(summary_groups),
+        summary_agents=model.agents_store.summary_agents(summary_groups),
+    )
+
+    logger.info(f"Running the model {ens_batch} ...")
+    try:
+        for i in range(TOTAL_TIMESTEPS):
+            logger.info(f" -- Step {i} ...")
+            model.step(i)
+            output_sink.write(model.steps, model.agents_store.state)
+    finally:
+        logger.info(f"Saving model outputs {ens_batch} ...")
+        output_sink.close()
+
+    for dataset_dir in dataset_dirs:
+        for partition in partitions:
+            write_file_manifest(dataset_dir, partition)
+
+
+def get_output_partition(cfg: dict, model_id: str, ens_i: int) -> dict:
+    """Obtain the partition of the outputs of an ensemble member
+
+    Args:
+        cfg (dict): run_model configuration, e.g., region and exp
+        model_id (str): Model ID
+        ens_i (int): Ensemble member
+
+    Returns:
+        dict: region, exp, model_id and ens
+    """
+    return {
+        "region": str(cfg.get("region") or "all"),
+        "exp": str(cfg.get("exp") or 0),
+        "model_id": str(model_id),
+        "ens": ens_i,
+    }
+
+
+def init_ens_worker(spec: dict):
+    """Attach the worker process to the model in shared memory
+
+    Args:
+        spec (dict): SharedModel.spec
+    """
+    ENS_WORKER["model"], ENS_WORKER["shared_memory"] = attach_model(spec)
+
+
+def run_ens_worker(ens_args: tuple) -> int:
+    """Run one ensemble member in a worker process
+
+    Args:
+        ens_args (tuple): arguments for run_ens_member (except the model)
+
+    Returns:
+        int: ensemble member
+    """
+    cfg, intital_timestep, ens_i, seed, output_dir, model_id = ens_args
+    run_ens_member(
+        ENS_WORKER["model"], cfg, intital_timestep, [ens_i], seed, output_dir, model_id
+    )
+    return ens_i
+
+
 def run_model_wrapper(workdir: str, cfg_path: str, model_id: str):
     """Run epimodel_ESR
 
@@ -62,41 +215,116 @@ def run_model_wrapper(workdir: str, cfg_path: str, model_id: str):
 
     cfg = read_cfg(cfg_path, task_name="run_model")
 
-    seed_infection = cfg["seed_infection"]
+    if cfg.get("batched_ens", False) and cfg.get("workers", 1) > 1:
+        raise Exception(
+            "batched_ens and workers > 1 can not be used together, "
+            "the batched ensemble members run in one process ..."
+        )
+
     intital_timestep = datetime.strptime(str(cfg["intital_timestep"]), "%Y%m%d")
 
     model = open_saved_model(get_model_path(workdir, model_id))
 
-    output_dir = join(workdir, "output")
+    # the outputs of different jobs (e.g., regions and experiments) can be
+    # written to one output directory
+    output_dir = cfg.get("output_dir") or join(workdir, "output")
     if not exists(output_dir):
         makedirs(output_dir)
 
-    for ens_i in range(ENS_NUMBER):
-        logger.info(f"Initialize the EpiModel_ESR {ens_i}...")
+    model.snapshot()
 
-        logger.info(f"Deep copying the model ...")
-        proc_model = deepcopy(model)
+    # the raw outputs only keep the agent rows (AgentID), which are decoded
+    # with the table written once for all ensemble members
+    if cfg.get("raw_output", True):
+        write_agents_table(
+            join(output_dir, RAW_DATASET),
+            get_output_partition(cfg, model_id, 0),
+            model.agents_store.decode_table(),
+        )
 
-        logger.info(f"Create initial infector ...")
-        proc_model.initial_infection(
-            seed_infection, intital_timestep, cleanup_agents=True
+    # each ensemble member gets its own child of one seed sequence, so the
+    # results do not depend on the number of workers or batched_ens (and the
+    # runs are reproducible if the seed is given)
+    seed_sequence = SeedSequence(cfg.get("seed"))
+    logger.info(f"Seed sequence entropy: {seed_sequence.entropy}")
+    ens_seeds = seed_sequence.spawn(ENS_NUMBER)
+
+    if cfg.get("batched_ens", False):
+        # all ensemble members run together in one batch (e.g., one pass
+        # over the timesteps)
+        run_ens_member(
+            model,
+            cfg,
+            intital_timestep,
+            list(range(ENS_NUMBER)),
+            ens_seeds,
+            output_dir,
+            model_id,
+            batched_ens=True,
         )
+    elif cfg.get("workers", 1) > 1:
+        # ensemble members are distributed over a local process pool,
+        # sharing one copy of the population structure
+        shared_model = SharedModel(model)
+        try:
+            with ProcessPoolExecutor(
+                max_workers=cfg["workers"],
+                initializer=init_ens_worker,
+                initargs=(shared_model.spec,),
+            ) as executor:
+                for ens_i in executor.map(
+                    run_ens_worker,
+                    [
+                        (cfg, intital_timestep, ens_i, ens_seed, output_dir, model_id)
+                        for ens_i, ens_seed in enumerate(ens_seeds)
+                    ],
+                ):
+                    logger.info(f"Ensemble member {ens_i} finished")
+        finally:
+            shared_model.close()
+    else:
+        for ens_i, ens_seed in enumerate(ens_seeds):
+            run_ens_member(
+                model, cfg, intital_timestep, [ens_i], ens_seed, output_dir, model_id
+            )
+
+    for dataset_name in [SUMMARY_DATASET, RAW_DATASET]:
+        if exists(join(output_dir, dataset_name)):
+            update_manifest(join(output_dir, dataset_name))
 
-        logger.info(f"Update measures ...")
-        proc_model.measures(intital_timestep, cfg["measures"])
+    logger.info("Simulation finished")
 
-        logger.info(f"Running the model {ens_i} ...")
-        for i in range(TOTAL_TIMESTEPS):
-            logger.info(f" -- Step {i} ...")
-            proc_model.step(i)
 
-        logger.info(f"Saving model outputs {ens_i} ...")
-        proc_model.postprocessing(intital_timestep)
-        proc_model.output.to_parquet(
-            join(output_dir, f"output_model_{model_id}_ens_{ens_i}.parquet")
-        )
+def get_output_dataset(
+    workdir: str, cfg_path: str, model_id: str or None = None
+) -> tuple:
+    """Obtain the output dataset of the runs (e.g., the region and exp in the
+    run_model configuration), the summary outputs are used if they are available
 
-    logger.info("Simulation finished")
+    Args:
+        workdir (str): Working directory
+        cfg_path (str): Configuration path
+        model_id (str or None, optional): Model ID, None for all models.
+            Defaults to None.
+
+    Returns:
+        tuple: dataset directory, if it is the summary dataset
+            and the partition filter
+    """
+    cfg = read_cfg(cfg_path, task_name="run_model")
+    output_dir = cfg.get("output_dir") or join(workdir, "output")
+
+    partition = get_output_partition(cfg, model_id, 0)
+    dataset_filter = (pyarrow_field("region") == partition["region"]) & (
+        pyarrow_field("exp") == partition["exp"]
+    )
+    if model_id is not None:
+        dataset_filter &= pyarrow_field("model_id") == partition["model_id"]
+
+    use_summary = exists(join(output_dir, SUMMARY_DATASET))
+    dataset_dir = join(output_dir, SUMMARY_DATASET if use_summary else RAW_DATASET)
+
+    return dataset_dir, use_summary, dataset_filter
 
 
 def run_vis_wrapper(workdir: str, cfg_path: str, model_id: str):
@@ -112,13 +340,10 @@ def run_vis_wrapper(workdir: str, cfg_path: str, model_id: str):
     obs_path = cfg["data_path"]["obs"]
     dhb_list = cfg["dhb_list"]
 
-    all_model_outputs = []
-
-    for ens_i in range(ENS_NUMBER):
-        proc_model = pandas_read_parquet(
-            join(workdir, "output", f"output_model_{model_id}_ens_{ens_i}.parquet")
-        )
-        all_model_outputs.append(proc_model)
+    dataset_dir, use_summary, dataset_filter = get_output_dataset(
+        workdir, cfg_path, model_id=model_id
+    )
+    all_model_outputs = read_outputs(dataset_dir, dataset_filter=dataset_filter)
 
     if obs_path is not None:
         obs = read_obs(obs_path, dhb_list, ref_year=2019)
@@ -134,6 +359,7 @@ def run_vis_wrapper(workdir: str, cfg_path: str, model_id: str):
         plot_weekly_data=True,
         obs=obs,
         filename=f"infection_{model_id}",
+        use_summary=use_summary,
     )
 
     logger.info("Visualization (Single) finished")
@@ -151,15 +377,19 @@ def run_ens_wrapper(workdir: str, cfg_path: str):
     obs_path = cfg["data_path"]["obs"]
     dhb_list = cfg["dhb_list"]
 
-    proc_data_list = []
-    all_files = glob(join(workdir, "output", "output_model_*.parquet"))
-    total_files = len(all_files)
-
     logger.info("Reading ens ...")
-    for i, proc_file in enumerate(all_files):
-        logger.info(f"{i}/{total_files} ...")
-        proc_data = read_parquet(proc_file)
-        proc_data_list.append(proc_data)
+    dataset_dir, use_summary, dataset_filter = get_output_dataset(workdir, cfg_path)
+    # the outputs are reduced to the daily counts as they are read
+    proc_data_list = read_all_state_counts(
+        [
+            proc_fragment.path
+            for proc_fragment in open_dataset(dataset_dir).get_fragments(
+                filter=dataset_filter
+            )
+        ],
+        [2],
+        use_summary=use_summary,
+    )
 
     if obs_path is not None:
         obs = read_obs(obs_path, dhb_list, ref_year=2019)
@@ -176,6 +406,8 @@ def run_ens_wrapper(workdir: str, cfg_path: str):
         title_str="Number of simulated and confirmed cases",
         filename=f"infection_all",
         remove_outlier=False,
+        use_summary=True,
+        stats_path=join(workdir, "vis", "stats", "ens_all"),
         # ylim_range=[0, 250],
     )
 